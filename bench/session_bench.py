@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+'''Benchmark session controllers
+
+Drives :meth:`BaseSessionController.__call__` with a fake request handler,
+the same way a Tornado handler does, for read-only, read-write and new
+session request mixes at several thread counts. Results are written as
+JSON.
+
+Example::
+
+    python3 bench/session_bench.py --controllers memory sqlite
+    python3 bench/session_bench.py --controllers mongodb --mongo-host db1
+
+'''
+# This file is part of PyWheel.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src',
+    'py3'))
+
+from pywheel.web.tornado.session import (CachingSessionController,
+    CookieSessionController, MemorySessionController,
+    StripedMemorySessionController)
+
+CONTROLLERS = ('memory', 'memory-lazy', 'memory-striped', 'sqlite',
+    'sqlite-lazy', 'sqlite-cached', 'cookie', 'mongodb')
+DEFAULT_CONTROLLERS = CONTROLLERS[:-1]
+MIXES = ('read', 'write', 'new')
+CONCURRENCY = (1, 4, 16)
+
+
+class FakeRequestHandler(object):
+    '''Stands in for :class:`tornado.web.RequestHandler`.'''
+
+    def __init__(self, cookie=None):
+        self.cookie = cookie
+
+    def get_secure_cookie(self, name):
+        return self.cookie
+
+    def set_secure_cookie(self, name, value, expires_days=None):
+        self.cookie = value
+
+
+def make_controller(name, temp_dir, args):
+    if name == 'memory':
+        return MemorySessionController()
+    elif name == 'memory-lazy':
+        return MemorySessionController(lazy=True)
+    elif name == 'memory-striped':
+        return StripedMemorySessionController(lazy=True)
+    elif name.startswith('sqlite'):
+        from pywheel.db.sqlitesession import SQLiteSessionController
+
+        path = os.path.join(temp_dir, name + '.db')
+        controller = SQLiteSessionController(path,
+            lazy=name == 'sqlite-lazy', pool_size=max(args.concurrency))
+
+        if name == 'sqlite-cached':
+            controller = CachingSessionController(controller)
+
+        return controller
+    elif name == 'cookie':
+        return CookieSessionController(MemorySessionController())
+    elif name == 'mongodb':
+        from pymongo.connection import Connection
+        from pywheel.db.mongodb import SessionController
+
+        collection = Connection(args.mongo_host).pywheel_bench.sessions
+        collection.drop()
+
+        return SessionController(collection)
+
+
+def make_value(size):
+    return {'text': 'x' * size, 'count': 0}
+
+
+def create_sessions(controller, count, value_size):
+    '''Save sessions through the controller and return their cookies.'''
+    cookies = []
+
+    for dummy in range(count):
+        handler = FakeRequestHandler()
+
+        with controller(handler) as session:
+            session.update(make_value(value_size))
+
+        cookies.append(handler.cookie)
+
+    return cookies
+
+
+def run_requests(controller, mix, cookies, request_count, value_size):
+    '''Run requests and return their latencies in seconds.'''
+    latencies = []
+
+    for dummy in range(request_count):
+        if mix == 'new':
+            handler = FakeRequestHandler()
+        else:
+            handler = FakeRequestHandler(random.choice(cookies))
+
+        start = time.perf_counter()
+
+        with controller(handler) as session:
+            if mix == 'read':
+                session.get('text')
+            elif mix == 'write':
+                session['count'] = session.get('count', 0) + 1
+            else:
+                session.update(make_value(value_size))
+
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+
+def run_case(controller, name, mix, concurrency, cookies, request_count,
+value_size):
+    per_worker = max(1, request_count // concurrency)
+    start = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        futures = [executor.submit(run_requests, controller, mix, cookies,
+            per_worker, value_size) for dummy in range(concurrency)]
+        results = [future.result() for future in futures]
+
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for result in results for latency in result)
+
+    return {
+        'controller': name,
+        'mix': mix,
+        'concurrency': concurrency,
+        'value_size': value_size,
+        'requests': len(latencies),
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed else None,
+        'p50': percentile(latencies, 0.50),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+
+    return sorted_values[index]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('--controllers', nargs='+',
+        default=DEFAULT_CONTROLLERS, choices=CONTROLLERS)
+    arg_parser.add_argument('--mixes', nargs='+', default=MIXES,
+        choices=MIXES)
+    arg_parser.add_argument('--concurrency', type=int, nargs='+',
+        default=CONCURRENCY)
+    arg_parser.add_argument('--requests', type=int, default=10000,
+        help='requests per case')
+    arg_parser.add_argument('--sessions', type=int, default=1000,
+        help='number of stored sessions')
+    arg_parser.add_argument('--value-size', type=int, default=200)
+    arg_parser.add_argument('--mongo-host', default='localhost')
+    arg_parser.add_argument('--output', help='write results to a JSON file')
+    args = arg_parser.parse_args()
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name in args.controllers:
+            controller = make_controller(name, temp_dir, args)
+            cookies = create_sessions(controller, args.sessions,
+                args.value_size)
+
+            for mix in args.mixes:
+                for concurrency in args.concurrency:
+                    result = run_case(controller, name, mix, concurrency,
+                        cookies, args.requests, args.value_size)
+                    results.append(result)
+
+                    print('{controller:<14} {mix:<6} {concurrency:>3} '
+                        '{requests_per_second:>10.0f} req/s  p50 {p50:.6f}  '
+                        'p99 {p99:.6f}'.format(**result), file=sys.stderr)
+
+            if hasattr(controller, 'close'):
+                controller.close()
+
+    document = {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(document, file, indent=2)
+    else:
+        json.dump(document, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+'''Compare Connector PRAGMA profiles on sqlitejsondbm workloads
+
+Example::
+
+    python3 bench/sqlite_profiles.py --keys 100000 1000000
+
+'''
+# This file is part of PyWheel.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src',
+    'py3'))
+
+from pywheel.db.sqlite import PROFILES
+from pywheel.db.sqlitejsondbm import Database
+
+
+def run_profile(profile, key_count, value_size, read_count, bulk_load):
+    '''Run the workload and return a ``dict`` of seconds per phase.'''
+    value = {'data': 'x' * value_size}
+    timings = {}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = Database(os.path.join(temp_dir, 'bench.db'), profile=profile)
+        items = (('key{:010d}'.format(i), value) for i in range(key_count))
+
+        start = time.perf_counter()
+
+        if bulk_load:
+            with db.connector.bulk_load():
+                db.set_many(items)
+        else:
+            db.set_many(items)
+
+        timings['load'] = time.perf_counter() - start
+
+        keys = ['key{:010d}'.format(random.randrange(key_count))
+            for dummy in range(read_count)]
+        start = time.perf_counter()
+
+        for key in keys:
+            db[key]
+
+        timings['random_read'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+
+        for key in keys[:read_count // 10]:
+            db[key] = value
+
+        timings['single_write'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+
+        for dummy in db.iteritems():
+            pass
+
+        timings['scan'] = time.perf_counter() - start
+        timings['size'] = db.connector.database_size
+
+        db.close()
+
+    return timings
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('--keys', type=int, nargs='+', default=[100000],
+        help='number of keys to load (for example 100000 10000000)')
+    arg_parser.add_argument('--value-size', type=int, default=100)
+    arg_parser.add_argument('--reads', type=int, default=10000)
+    arg_parser.add_argument('--profiles', nargs='+',
+        default=sorted(PROFILES.keys()), choices=sorted(PROFILES.keys()))
+    args = arg_parser.parse_args()
+
+    print('{:>10} {:>16} {:>9} {:>9} {:>9} {:>9} {:>12}'.format('keys',
+        'profile', 'load', 'read', 'write', 'scan', 'size'))
+
+    for key_count in args.keys:
+        for profile in args.profiles:
+            for bulk_load in (False, True):
+                timings = run_profile(profile, key_count, args.value_size,
+                    args.reads, bulk_load)
+                name = profile + ('+bulk' if bulk_load else '')
+
+                print('{:>10} {:>16} {load:9.3f} {random_read:9.3f} '
+                    '{single_write:9.3f} {scan:9.3f} {size:12d}'.format(
+                        key_count, name, **timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+'''Benchmark sqlitejsondbm.Database operations
+
+Runs get, set, delete, len and iteration with one thread, several threads
+and several processes over a range of value sizes, with and without a warm
+read cache. Results are written as JSON. A previous result file can be
+given to report regressions.
+
+Example::
+
+    python3 bench/sqlitejsondbm_bench.py --output new.json
+    python3 bench/sqlitejsondbm_bench.py --compare new.json --threshold 0.2
+
+'''
+# This file is part of PyWheel.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src',
+    'py3'))
+
+from pywheel.db.sqlitejsondbm import Database
+
+OPERATIONS = ('set', 'get', 'delete', 'len', 'iter')
+MODES = ('single', 'threads', 'processes')
+CACHES = ('cold', 'warm')
+VALUE_SIZES = (100, 1000, 10000, 100000, 1000000)
+
+
+def make_key(index):
+    return 'key{:010d}'.format(index)
+
+
+def make_value(size):
+    return {'data': 'x' * size}
+
+
+def open_database(path, cache):
+    if cache == 'warm':
+        return Database(path, cache_items=100000)
+    else:
+        return Database(path)
+
+
+def run_operation(path, operation, cache, keys, value_size):
+    '''Run an operation on the keys and return the latencies in seconds.
+
+    Used directly by threads and through :func:`run_worker` by processes.
+    '''
+    db = open_database(path, cache)
+    value = make_value(value_size)
+    latencies = []
+
+    if cache == 'warm' and operation == 'get':
+        db.get_many(keys)
+
+    for key in keys:
+        start = time.perf_counter()
+
+        if operation == 'set':
+            db[key] = value
+        elif operation == 'get':
+            db[key]
+        elif operation == 'delete':
+            del db[key]
+        elif operation == 'len':
+            len(db)
+        elif operation == 'iter':
+            for dummy in db.iterkeys(start=key, batch_size=100):
+                break
+
+        latencies.append(time.perf_counter() - start)
+
+    db.close()
+
+    return latencies
+
+
+def run_worker(args):
+    return run_operation(*args)
+
+
+def run_case(path, operation, mode, workers, cache, key_count, value_size):
+    '''Prepare the database, run one case and return its result.'''
+    db = Database(path)
+    db.delete_many(list(db.iterkeys()))
+
+    if operation != 'set':
+        value = make_value(value_size)
+        db.set_many((make_key(i), value) for i in range(key_count))
+
+    db.close()
+
+    worker_count = 1 if mode == 'single' else workers
+    slices = [[make_key(i) for i in range(worker_index, key_count,
+        worker_count)] for worker_index in range(worker_count)]
+    jobs = [(path, operation, cache, keys, value_size) for keys in slices]
+
+    start = time.perf_counter()
+
+    if mode == 'single':
+        results = [run_worker(jobs[0])]
+    elif mode == 'threads':
+        with concurrent.futures.ThreadPoolExecutor(worker_count) as executor:
+            results = list(executor.map(run_worker, jobs))
+    else:
+        with multiprocessing.Pool(worker_count) as pool:
+            results = pool.map(run_worker, jobs)
+
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for result in results for latency in result)
+
+    return {
+        'operation': operation,
+        'mode': mode,
+        'workers': worker_count,
+        'cache': cache,
+        'value_size': value_size,
+        'ops': len(latencies),
+        'seconds': elapsed,
+        'ops_per_second': len(latencies) / elapsed if elapsed else None,
+        'p50': percentile(latencies, 0.50),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+
+    return sorted_values[index]
+
+
+def case_id(result):
+    return '{operation}/{mode}/{workers}/{cache}/{value_size}'.format(
+        **result)
+
+
+def compare(baseline_path, results, threshold):
+    '''Print the change against a baseline and return the regressions.'''
+    with open(baseline_path) as file:
+        baseline = dict((case_id(result), result)
+            for result in json.load(file)['results'])
+
+    regressions = []
+
+    for result in results:
+        old_result = baseline.get(case_id(result))
+
+        if not old_result or not old_result['ops_per_second']:
+            continue
+
+        change = result['ops_per_second'] / old_result['ops_per_second'] - 1
+
+        print('{:<40} {:+8.1%}'.format(case_id(result), change))
+
+        if change < -threshold:
+            regressions.append(case_id(result))
+
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('--operations', nargs='+', default=OPERATIONS,
+        choices=OPERATIONS)
+    arg_parser.add_argument('--modes', nargs='+', default=MODES,
+        choices=MODES)
+    arg_parser.add_argument('--caches', nargs='+', default=CACHES,
+        choices=CACHES)
+    arg_parser.add_argument('--value-sizes', type=int, nargs='+',
+        default=VALUE_SIZES)
+    arg_parser.add_argument('--workers', type=int, default=4)
+    arg_parser.add_argument('--ops', type=int, default=2000,
+        help='maximum operations per case')
+    arg_parser.add_argument('--bytes-per-case', type=int, default=200000000,
+        help='limits the operations per case for large values')
+    arg_parser.add_argument('--output', help='write results to a JSON file')
+    arg_parser.add_argument('--compare',
+        help='a previous JSON result file to compare against')
+    arg_parser.add_argument('--threshold', type=float, default=0.2,
+        help='throughput drop reported as a regression')
+    args = arg_parser.parse_args()
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'bench.db')
+
+        for value_size in args.value_sizes:
+            key_count = max(args.workers,
+                min(args.ops, args.bytes_per_case // value_size))
+
+            for operation in args.operations:
+                for mode in args.modes:
+                    for cache in args.caches:
+                        if cache == 'warm' and operation != 'get':
+                            continue
+
+                        result = run_case(path, operation, mode, args.workers,
+                            cache, key_count, value_size)
+                        results.append(result)
+
+                        print('{:<40} {:>10.0f} ops/s  p50 {:.6f}  '
+                            'p99 {:.6f}'.format(case_id(result),
+                                result['ops_per_second'], result['p50'],
+                                result['p99']), file=sys.stderr)
+
+    document = {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(document, file, indent=2)
+    else:
+        json.dump(document, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        regressions = compare(args.compare, results, args.threshold)
+
+        if regressions:
+            print('Regressions:', ', '.join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
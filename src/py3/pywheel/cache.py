@@ -0,0 +1,115 @@
+'''In-process caching'''
+# This file is part of PyWheel.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+import collections
+import threading
+
+
+class LRUCache(object):
+    def __init__(self, max_items=None, max_size=None):
+        '''A thread-safe least recently used cache.
+
+        :param max_items: The maximum number of entries.
+        :param max_size: The maximum sum of the sizes given to :meth:`put`.
+
+        Every :meth:`discard` and :meth:`clear` increments
+        :attr:`generation`. A reader that loaded a value from a slower
+        store can pass the generation it saw before loading to :meth:`put`
+        so a value made stale by a concurrent write is not cached.
+        '''
+
+        self._max_items = max_items
+        self._max_size = max_size
+        self._table = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        '''Return the value and mark it as recently used.'''
+        with self._lock:
+            try:
+                value, size = self._table[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._table.move_to_end(key)
+            self.hits += 1
+
+            return value
+
+    def put(self, key, value, size=1, generation=None):
+        '''Store a value.
+
+        :param size: The approximate size of the value.
+        :param generation: If given and it is not the current
+            :attr:`generation`, the value is not stored.
+        :returns: Whether the value was stored.
+        '''
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+
+            if self._max_size is not None and size > self._max_size:
+                self._remove(key)
+                return False
+
+            self._remove(key)
+            self._table[key] = (value, size)
+            self._size += size
+
+            while self._table and (
+            self._max_items is not None and len(self._table) > self._max_items
+            or self._max_size is not None and self._size > self._max_size):
+                self._size -= self._table.popitem(last=False)[1][1]
+
+            return True
+
+    def discard(self, key):
+        '''Remove a value if it exists.'''
+        with self._lock:
+            self._remove(key)
+            self._generation += 1
+
+    def clear(self):
+        '''Remove all values.'''
+        with self._lock:
+            self._table.clear()
+            self._size = 0
+            self._generation += 1
+
+    def _remove(self, key):
+        entry = self._table.pop(key, None)
+
+        if entry:
+            self._size -= entry[1]
+
+    @property
+    def generation(self):
+        '''A counter incremented by every removal.'''
+        return self._generation
+
+    @property
+    def size(self):
+        '''The sum of the sizes of the stored values.'''
+        return self._size
+
+    @property
+    def hit_rate(self):
+        '''The fraction of lookups that were hits.'''
+        total = self.hits + self.misses
+
+        if total:
+            return self.hits / total
+        else:
+            return 0.0
+
+    def __len__(self):
+        return len(self._table)
+
+    def __contains__(self, key):
+        return key in self._table
@@ -0,0 +1,44 @@
+# This file is part of PyWheel.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+from pywheel.cache import LRUCache
+import unittest
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_max_items(self):
+        '''It should evict the least recently used entry'''
+
+        cache = LRUCache(max_items=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(1, cache.hits)
+
+    def test_max_size(self):
+        '''It should evict entries until the size fits'''
+
+        cache = LRUCache(max_size=10)
+        cache.put('a', 1, size=6)
+        cache.put('b', 2, size=6)
+
+        self.assertEqual(1, len(cache))
+        self.assertEqual(6, cache.size)
+        self.assertFalse(cache.put('c', 3, size=11))
+        self.assertEqual(None, cache.get('c'))
+        self.assertEqual(1, cache.misses)
+
+    def test_generation(self):
+        '''It should not store a value loaded before a removal'''
+
+        cache = LRUCache()
+        generation = cache.generation
+        cache.discard('a')
+
+        self.assertFalse(cache.put('a', 1, generation=generation))
+        self.assertTrue(cache.put('a', 1, generation=cache.generation))
@@ -0,0 +1,177 @@
+'''Asyncio front-end for :mod:`pywheel.db.sqlitejsondbm`'''
+# This file is part of PyWheel.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+from pywheel.db.sqlitejsondbm import Database
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+
+_logger = logging.getLogger(__name__)
+
+
+class AsyncDatabase(object):
+    '''A :class:`.Database` that does not block the event loop.
+
+    Reads run in a small thread pool. Because the database is in WAL mode,
+    they do not wait for writes. Writes are queued to a single writer
+    thread. The writer commits everything waiting in the queue, up to
+    `max_batch` operations, in one transaction, so concurrent writers
+    share a commit.
+
+    Example::
+
+        db = AsyncDatabase('/tmp/kittens.db')
+        await db.set('kitteh', {'lives': 9})
+        value = await db.get('kitteh')
+        await db.close()
+
+    '''
+
+    def __init__(self, path, readers=4, max_batch=1000, **database_kwargs):
+        '''Open the database.
+
+        :param readers: The number of reader threads.
+        :param max_batch: The maximum number of writes per commit.
+
+        Other arguments are passed to :class:`.Database`.
+        '''
+        database_kwargs.setdefault('pool_size', readers + 1)
+
+        self._database = Database(path, **database_kwargs)
+        self._readers = concurrent.futures.ThreadPoolExecutor(readers)
+        self._max_batch = max_batch
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.name = 'AsyncDatabase writer'
+        self._writer.daemon = True
+        self._writer.start()
+
+    @property
+    def database(self):
+        '''The wrapped :class:`.Database`.'''
+        return self._database
+
+    async def get(self, k, default=None):
+        '''Return the value of a key or `default`.'''
+        return await self._read(self._get, k, default)
+
+    def _get(self, k, default):
+        try:
+            return self._database[k]
+        except IndexError:
+            return default
+
+    async def contains(self, k):
+        '''Return whether the key exists.'''
+        return await self._read(self._database.__contains__, k)
+
+    async def get_many(self, keys):
+        '''See :meth:`.Database.get_many`.'''
+        return await self._read(self._database.get_many, list(keys))
+
+    async def len(self):
+        '''Return the number of keys.'''
+        return await self._read(len, self._database)
+
+    async def set(self, k, v):
+        '''Store a value.'''
+        return await self._write(self._database.__setitem__, k, v)
+
+    async def delete(self, k):
+        '''Delete a key. Missing keys are ignored.'''
+        return await self._write(self._database.__delitem__, k)
+
+    async def update(self, k, v):
+        '''See :meth:`.Database.update`.'''
+        return await self._write(self._database.update, k, v)
+
+    async def set_many(self, items):
+        '''See :meth:`.Database.set_many`.'''
+        return await self._write(self._database.set_many, items)
+
+    async def delete_many(self, keys):
+        '''See :meth:`.Database.delete_many`.'''
+        return await self._write(self._database.delete_many, keys)
+
+    async def close(self):
+        '''Wait for queued writes and close the database.'''
+        self._queue.put(None)
+        loop = asyncio.get_event_loop()
+
+        await loop.run_in_executor(None, self._writer.join)
+        self._readers.shutdown()
+        self._database.close()
+
+    def _read(self, function, *args):
+        loop = asyncio.get_event_loop()
+
+        return loop.run_in_executor(self._readers, function, *args)
+
+    def _write(self, function, *args):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        self._queue.put((function, args, future, loop))
+
+        return future
+
+    def _write_loop(self):
+        running = True
+
+        while running:
+            batch = [self._queue.get()]
+
+            while len(batch) < self._max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                running = False
+                batch = [item for item in batch if item is not None]
+
+            if batch:
+                self._commit(batch)
+
+    def _commit(self, batch):
+        '''Run writes in one transaction and resolve their futures.
+
+        Each write is in its own savepoint so a failing write does not undo
+        the others.
+        '''
+        results = []
+
+        try:
+            with self._database.transaction():
+                for function, args, future, loop in batch:
+                    try:
+                        with self._database.transaction():
+                            result = function(*args)
+                    except Exception as error:
+                        results.append((future, loop, None, error))
+                    else:
+                        results.append((future, loop, result, None))
+        except Exception as error:
+            _logger.exception('Group commit failed')
+            results = [(future, loop, None, error)
+                for function, args, future, loop in batch]
+
+        for future, loop, result, error in results:
+            try:
+                loop.call_soon_threadsafe(_resolve, future, result, error)
+            except RuntimeError:
+                _logger.debug('Event loop closed before write finished')
+
+
+def _resolve(future, result, error):
+    if future.cancelled():
+        return
+
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
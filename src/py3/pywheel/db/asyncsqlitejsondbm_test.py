@@ -0,0 +1,42 @@
+# This file is part of PyWheel.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+from pywheel.db.asyncsqlitejsondbm import AsyncDatabase
+import asyncio
+import os
+import tempfile
+import unittest
+
+
+class TestAsyncDatabase(unittest.TestCase):
+    def test_simple(self):
+        tempdir = tempfile.TemporaryDirectory()
+
+        async def f():
+            db = AsyncDatabase(os.path.join(tempdir.name, 'kittens.db'))
+
+            await asyncio.gather(*[db.set('key{}'.format(i), i)
+                for i in range(100)])
+
+            self.assertEqual(100, await db.len())
+            self.assertEqual(5, await db.get('key5'))
+            self.assertEqual(None, await db.get('non_existant'))
+
+            await db.delete('key5')
+
+            self.assertFalse(await db.contains('key5'))
+
+            await db.set_many({'a': {'x': 1}})
+            await db.update('a', {'y': 2})
+
+            self.assertEqual({'a': {'x': 1, 'y': 2}},
+                await db.get_many(['a']))
+
+            with self.assertRaises(AttributeError):
+                await db.update('key6', {})
+
+            self.assertEqual(6, await db.get('key6'))
+
+            await db.close()
+
+        asyncio.run(f())
@@ -0,0 +1,132 @@
+'''Value serializers for storing Python objects in databases
+
+Each codec has a numeric tag which is stored next to the encoded value so
+values written by different codecs can be read back.
+'''
+# This file is part of PyWheel.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+import abc
+import json
+import marshal
+import pickle
+import zlib
+
+COMPRESSED = 0x100
+'''Flag added to the tag of a zlib compressed value'''
+
+
+class Codec(object, metaclass=abc.ABCMeta):
+    '''Converts values to and from ``str`` or ``bytes``'''
+
+    tag = None
+    '''The ``int`` stored next to values encoded by the codec'''
+
+    @abc.abstractmethod
+    def encode(self, value):
+        '''Return the value as ``str`` or ``bytes``.'''
+        pass
+
+    @abc.abstractmethod
+    def decode(self, data):
+        '''Return the value from ``str`` or ``bytes``.'''
+        pass
+
+
+class JSONCodec(Codec):
+    '''JSON stored as text'''
+
+    tag = 0
+
+    def encode(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def decode(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+
+        return json.loads(data)
+
+
+class PickleCodec(Codec):
+    '''Pickle stored as a blob
+
+    .. warning::
+
+        Only read pickles from trusted databases.
+    '''
+
+    tag = 1
+
+    def encode(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class MarshalCodec(Codec):
+    '''Compact binary stored as a blob
+
+    It is faster and smaller than JSON for nested built-in types such as
+    ``dict``, ``list``, ``str``, ``bytes`` and numbers. Other types are
+    not supported.
+
+    .. warning::
+
+        The :mod:`marshal` format is not guaranteed to be stable across
+        Python versions, so values may become unreadable after a Python
+        upgrade. Use it only for data that can be rebuilt, such as caches,
+        and convert stored values to another codec before upgrading.
+        Like pickles, only read it from trusted databases.
+    '''
+
+    tag = 2
+
+    def encode(self, value):
+        return marshal.dumps(value)
+
+    def decode(self, data):
+        return marshal.loads(data)
+
+
+CODECS = dict((codec.tag, codec)
+    for codec in (JSONCodec(), PickleCodec(), MarshalCodec()))
+'''Codec instances by tag'''
+
+
+def encode(codec, value, compress_threshold=None, compress_level=6):
+    '''Encode a value.
+
+    :param codec: A :class:`Codec`.
+    :param compress_threshold: If given, encoded values longer than this
+        many bytes are compressed with zlib.
+    :returns: A tuple of the tag and the ``str`` or ``bytes``.
+    '''
+    data = codec.encode(value)
+    tag = codec.tag
+
+    if compress_threshold is not None and len(data) > compress_threshold:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        data = zlib.compress(data, compress_level)
+        tag |= COMPRESSED
+
+    return tag, data
+
+
+def decode(tag, data, codecs=None):
+    '''Decode a value encoded by :func:`encode`.
+
+    :param codecs: A ``dict`` of codecs by tag. The default is
+        :data:`CODECS`. Pass a copy that includes custom codecs to read
+        values they wrote.
+    '''
+    if codecs is None:
+        codecs = CODECS
+
+    if tag & COMPRESSED:
+        data = zlib.decompress(data)
+
+    return codecs[tag & ~COMPRESSED].decode(data)
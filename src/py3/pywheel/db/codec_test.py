@@ -0,0 +1,34 @@
+# This file is part of PyWheel.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+from pywheel.db import codec
+import unittest
+
+
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        '''It should decode what it encoded'''
+
+        value = {'kittens': [1, 2.5, 'meow', None, True]}
+
+        for codec_instance in codec.CODECS.values():
+            tag, data = codec.encode(codec_instance, value)
+
+            self.assertEqual(codec_instance.tag, tag)
+            self.assertEqual(value, codec.decode(tag, data))
+
+    def test_compress(self):
+        '''It should compress values above the threshold'''
+
+        value = 'kitteh' * 100
+        tag, data = codec.encode(codec.JSONCodec(), value,
+            compress_threshold=100)
+
+        self.assertTrue(tag & codec.COMPRESSED)
+        self.assertLess(len(data), 100)
+        self.assertEqual(value, codec.decode(tag, data))
+
+        tag, data = codec.encode(codec.JSONCodec(), 'kitteh',
+            compress_threshold=100)
+
+        self.assertFalse(tag & codec.COMPRESSED)
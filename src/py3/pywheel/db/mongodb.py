@@ -7,7 +7,8 @@ from pymongo.connection import Connection
 from pymongo.errors import ConnectionFailure
 from pywheel.backoff import ExpBackoff, Trier
 from pywheel._gettexthelper import _
-from pywheel.web.tornado.session import BaseSessionController
+from pywheel.web.tornado.session import (BaseSessionController,
+    ThreadedSessionController)
 import datetime
 import logging
 import time
@@ -52,35 +53,96 @@ class SessionController(BaseSessionController):
     DATA = 'dat'
     LAST_MODIFIED = 'last_mod'
 
-    def __init__(self, collection):
+    def __init__(self, collection, ttl_index=False):
         '''Session controller using MongoDB
 
+        An index on the last modified time is ensured so :meth:`clean`
+        does not scan the collection.
+
         :type collection: :class:`pymongo.collection.Collection`
+        :param ttl_index: If `True`, the index is a TTL index and MongoDB
+            deletes expired sessions itself. Requires MongoDB 2.2.
         '''
         self._collection = collection
 
+        if ttl_index:
+            self._collection.ensure_index(self.LAST_MODIFIED,
+                expireAfterSeconds=BaseSessionController.EXPIRE_TIME)
+        else:
+            self._collection.ensure_index(self.LAST_MODIFIED)
+
     def get_session_dict(self, id_):
         doc = self._collection.find_one({'_id': ObjectId(id_)})
 
         if doc:
             return doc[self.DATA]
 
+    def get_session_dicts(self, ids):
+        ids = dict((ObjectId(id_), id_) for id_ in ids)
+        session_dicts = {}
+
+        if ids:
+            for doc in self._collection.find({'_id': {'$in': list(ids)}}):
+                session_dicts[ids[doc['_id']]] = self._load_session(
+                    doc[self.DATA])
+
+        return session_dicts
+
     def save_session_dict(self, session_dict):
+        self._collection.save(self._make_doc(session_dict))
+
+    def save_session_dicts(self, session_dicts):
+        bulk = self._collection.initialize_unordered_bulk_op()
+        empty = True
+
+        for session_dict in session_dicts:
+            doc = self._make_doc(session_dict)
+            bulk.find({'_id': doc['_id']}).upsert().replace_one(doc)
+            empty = False
+
+        if not empty:
+            bulk.execute()
+
+    def _make_doc(self, session_dict):
         if not session_dict.id:
             session_dict.id = ObjectId().binary
 
-        self._collection.save({
+        return {
             '_id': ObjectId(session_dict.id),
             self.LAST_MODIFIED: datetime.datetime.utcfromtimestamp(
                 session_dict.last_modified),
             self.DATA: session_dict
-        })
+        }
 
-    def clean(self):
-        expire_date = datetime.datetime.fromtimestamp(
+    def clean(self, max_items=None):
+        expire_date = datetime.datetime.utcfromtimestamp(
             time.time() - BaseSessionController.EXPIRE_TIME)
+        spec = {self.LAST_MODIFIED: {'$lt': expire_date}}
 
-        self._collection.remove({self.LAST_MODIFIED: {'$lt': expire_date}})
+        if max_items is None:
+            self._collection.remove(spec)
+            return
+
+        ids = [doc['_id'] for doc in self._collection.find(spec, ['_id'])
+            .sort(self.LAST_MODIFIED).limit(max_items)]
+
+        if ids:
+            self._collection.remove({'_id': {'$in': ids}})
+
+        return len(ids)
+
+
+class AsyncSessionController(ThreadedSessionController):
+    def __init__(self, collection, executor=None):
+        '''Session controller using MongoDB for coroutines
+
+        PyMongo calls run in `executor`.
+        See :class:`.ThreadedSessionController`.
+
+        :type collection: :class:`pymongo.collection.Collection`
+        '''
+        ThreadedSessionController.__init__(self,
+            SessionController(collection), executor)
 
 
 class AggregateTagsCode(object):
@@ -31,6 +31,43 @@ class TestSessionController(unittest.TestCase):
         self.assertTrue(test_dict)
         self.assertEqual('kitten', test_dict['hello'])
 
+    def test_bulk(self):
+        '''It should save and get many sessions'''
+
+        s = SessionController(self.coll)
+        session_dicts = [Session(number=i) for i in range(10)]
+
+        s.save_session_dicts(session_dicts)
+
+        ids = [session_dict.id for session_dict in session_dicts]
+        test_dicts = s.get_session_dicts(ids)
+
+        self.assertEqual(10, len(test_dicts))
+        self.assertEqual(9, test_dicts[ids[9]]['number'])
+
+        test_dicts[ids[9]]['number'] = 99
+        s.save_session_dicts(test_dicts.values())
+
+        self.assertEqual(99, s.get_session_dict(ids[9])['number'])
+
+    def test_clean(self):
+        '''It should delete expired sessions'''
+
+        s = SessionController(self.coll)
+        session_dicts = [Session() for dummy in range(3)]
+
+        for session_dict in session_dicts[:2]:
+            s.save_session_dict(session_dict)
+
+        session_dicts[2].last_modified = int(time.time())
+        s.save_session_dict(session_dicts[2])
+
+        self.assertEqual(1, s.clean(max_items=1))
+        s.clean()
+
+        self.assertEqual(None, s.get_session_dict(session_dicts[1].id))
+        self.assertTrue(s.get_session_dict(session_dicts[2].id))
+
 
 class TestReconnector(unittest.TestCase):
     def test_fail(self):
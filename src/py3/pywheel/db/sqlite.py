@@ -2,8 +2,299 @@
 # This file is part of PyWheel.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
+import bisect
+import collections
 import contextlib
+import logging
 import sqlite3
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class StatementStats(object):
+    '''Timings of one SQL statement'''
+
+    __slots__ = ('count', 'total_time', 'max_time', 'rows', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.histogram = [0] * len(QueryStats.BUCKETS)
+        '''Counts of executions by :attr:`QueryStats.BUCKETS`'''
+
+    @property
+    def mean_time(self):
+        if self.count:
+            return self.total_time / self.count
+        else:
+            return 0.0
+
+
+class QueryStats(object):
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+        float('inf'))
+    '''Upper bounds in seconds of the histogram buckets'''
+
+    def __init__(self, slow_query_threshold=None):
+        '''Statement counts and timings collected by a :class:`Connector`.
+
+        :param slow_query_threshold: If given, statements taking longer
+            than this many seconds are logged as warnings.
+
+        Example::
+
+            stats = QueryStats(slow_query_threshold=0.1)
+            connector = Connector('/tmp/kittens.db', stats=stats)
+
+            ...
+
+            for sql, statement_stats in stats.top():
+                print(sql, statement_stats.count, statement_stats.total_time)
+
+        '''
+        self.slow_query_threshold = slow_query_threshold
+        self._statements = collections.defaultdict(StatementStats)
+        self._lock = threading.Lock()
+
+    def record(self, sql, duration, rows=0):
+        '''Record an execution of a statement.
+
+        :param duration: Seconds spent executing the statement and
+            fetching its rows.
+        :param rows: The number of rows fetched.
+        '''
+        with self._lock:
+            statement_stats = self._statements[sql]
+            statement_stats.count += 1
+            statement_stats.rows += rows
+            statement_stats.total_time += duration
+            statement_stats.max_time = max(statement_stats.max_time, duration)
+            statement_stats.histogram[
+                bisect.bisect_left(self.BUCKETS, duration)] += 1
+
+        if self.slow_query_threshold is not None \
+        and duration > self.slow_query_threshold:
+            _logger.warning('Slow query (%.3f s): %s', duration, sql)
+
+    @property
+    def statements(self):
+        '''A ``dict`` of SQL to :class:`StatementStats`.'''
+        with self._lock:
+            return dict(self._statements)
+
+    def top(self, limit=10):
+        '''Return ``(sql, StatementStats)`` pairs by total time, slowest
+        first.'''
+        return sorted(self.statements.items(),
+            key=lambda item: item[1].total_time, reverse=True)[:limit]
+
+    def reset(self):
+        '''Forget all recorded statements.'''
+        with self._lock:
+            self._statements.clear()
+
+
+class _InstrumentedCursor(sqlite3.Cursor):
+    '''A cursor that records timings to the connection's
+    :class:`QueryStats`.
+
+    An execution is recorded once its rows are exhausted or the cursor is
+    reused, closed or collected, so the time to fetch rows is included.
+    '''
+
+    _sql = None
+    _elapsed = 0.0
+    _rows = 0
+
+    def execute(self, sql, parameters=()):
+        return self._timed(sqlite3.Cursor.execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(sqlite3.Cursor.executemany, sql,
+            seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self._timed(sqlite3.Cursor.executescript, sql_script)
+
+    def _timed(self, function, sql, *args):
+        self._finish()
+        self._sql = sql
+        start = time.perf_counter()
+
+        try:
+            result = function(self, sql, *args)
+        except Exception:
+            self._elapsed += time.perf_counter() - start
+            self._finish()
+            raise
+
+        self._elapsed += time.perf_counter() - start
+
+        if self.description is None:
+            self._finish()
+
+        return result
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = sqlite3.Cursor.fetchone(self)
+        self._elapsed += time.perf_counter() - start
+
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+
+        return row
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        rows = sqlite3.Cursor.fetchmany(self, *args)
+        self._elapsed += time.perf_counter() - start
+        self._rows += len(rows)
+
+        if not rows:
+            self._finish()
+
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = sqlite3.Cursor.fetchall(self)
+        self._elapsed += time.perf_counter() - start
+        self._rows += len(rows)
+        self._finish()
+
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+
+        try:
+            row = sqlite3.Cursor.__next__(self)
+        except StopIteration:
+            self._elapsed += time.perf_counter() - start
+            self._finish()
+            raise
+
+        self._elapsed += time.perf_counter() - start
+        self._rows += 1
+
+        return row
+
+    def close(self):
+        self._finish()
+        sqlite3.Cursor.close(self)
+
+    def __del__(self):
+        self._finish()
+
+    def _finish(self):
+        '''Record the current execution.'''
+        if self._sql is None:
+            return
+
+        self.connection.stats.record(self._sql, self._elapsed, self._rows)
+        self._sql = None
+        self._elapsed = 0.0
+        self._rows = 0
+
+
+class _InstrumentedConnection(sqlite3.Connection):
+    '''A connection whose cursors record timings.'''
+
+    stats = None
+
+    def cursor(self, factory=_InstrumentedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+PROFILES = {
+    'default': (
+        ('synchronous', 'NORMAL'),
+        ('journal_mode', 'WAL'),
+        ('foreign_keys', 'ON'),
+    ),
+    'read_heavy': (
+        ('synchronous', 'NORMAL'),
+        ('journal_mode', 'WAL'),
+        ('foreign_keys', 'ON'),
+        ('mmap_size', 268435456),
+        ('cache_size', -65536),
+        ('temp_store', 'MEMORY'),
+        ('busy_timeout', 5000),
+    ),
+    'write_heavy': (
+        ('page_size', 8192),
+        ('synchronous', 'NORMAL'),
+        ('journal_mode', 'WAL'),
+        ('foreign_keys', 'ON'),
+        ('cache_size', -32768),
+        ('temp_store', 'MEMORY'),
+        ('wal_autocheckpoint', 10000),
+        ('busy_timeout', 10000),
+    ),
+    'bulk_load': (
+        ('page_size', 8192),
+        ('synchronous', 'OFF'),
+        ('journal_mode', 'WAL'),
+        ('foreign_keys', 'ON'),
+        ('cache_size', -262144),
+        ('temp_store', 'MEMORY'),
+        ('wal_autocheckpoint', 100000),
+        ('busy_timeout', 10000),
+    ),
+    'durable': (
+        ('synchronous', 'FULL'),
+        ('journal_mode', 'WAL'),
+        ('foreign_keys', 'ON'),
+        ('busy_timeout', 5000),
+    ),
+}
+'''PRAGMA settings by profile name
+
+Each profile is a sequence of ``(name, value)`` applied in order.
+``page_size`` only takes effect on new databases. Negative ``cache_size``
+values are in KiB.
+'''
+
+
+PASSIVE = 'PASSIVE'
+'''Checkpoint as much as possible without waiting for readers or writers'''
+FULL = 'FULL'
+'''Wait for writers, then checkpoint the whole WAL'''
+RESTART = 'RESTART'
+'''Like :data:`FULL`, then wait for readers so the WAL restarts'''
+TRUNCATE = 'TRUNCATE'
+'''Like :data:`RESTART`, then truncate the WAL file to zero bytes'''
+
+CheckpointResult = collections.namedtuple('CheckpointResult',
+    ['busy', 'log_pages', 'checkpointed_pages'])
+'''The result of :meth:`Connector.checkpoint`'''
+
+
+class _PooledConnection(object):
+    '''Book-keeping for a connection owned by a pool.'''
+
+    __slots__ = ('connection', 'last_used', 'pragma_generation')
+
+    def __init__(self, connection, pragma_generation):
+        self.connection = connection
+        self.last_used = time.time()
+        self.pragma_generation = pragma_generation
 
 
 class Connector(object):
@@ -18,31 +309,329 @@ class Connector(object):
         with connector() as connection:
             connection.execute("SOME STATEMENTS")
 
+    If `pool_size` is given, connections are kept open and reused instead
+    of being opened for every call. A thread gets back the connection it
+    used last if that connection is idle. At most `pool_size` connections
+    are open at once; further callers wait up to `pool_timeout` seconds.
+
+    .. note::
+
+        A thread that nests calls holds one pooled connection per level.
+
+    If `stats` is given, every statement run on the connections is timed.
+    See :class:`QueryStats`.
     '''
 
-    def __init__(self, path, **sqlite_kwargs):
-        '''Create a new connection using given path.'''
+    def __init__(self, path, pool_size=0, max_idle_time=300.0,
+    health_check_interval=30.0, pool_timeout=30.0, stats=None,
+    cached_statements=256, profile='default', pragmas=None,
+    **sqlite_kwargs):
+        '''Create a new connection using given path.
+
+        :param pool_size: The maximum number of pooled connections. If ``0``,
+            pooling is disabled.
+        :param max_idle_time: Seconds before an idle pooled connection is
+            closed.
+        :param health_check_interval: Seconds of idleness after which a
+            pooled connection is checked before it is handed out.
+        :param pool_timeout: Seconds to wait for a free pooled connection.
+            ``None`` waits forever.
+        :param stats: A :class:`QueryStats`.
+        :param cached_statements: The number of prepared statements cached
+            by each connection.
+        :param profile: A name in :data:`PROFILES`.
+        :param pragmas: A mapping of PRAGMA settings that override the
+            profile.
+        '''
 
         kwargs = dict(isolation_level='DEFERRED',
-            detect_types=sqlite3.PARSE_DECLTYPES
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            cached_statements=cached_statements,
         )
 
+        if pool_size:
+            kwargs['check_same_thread'] = False
+
+        if stats:
+            kwargs['factory'] = _InstrumentedConnection
+
         kwargs.update(sqlite_kwargs)
 
         self._kwargs = kwargs
         self._path = path
+        self._pool_size = pool_size
+        self._max_idle_time = max_idle_time
+        self._health_check_interval = health_check_interval
+        self._pool_timeout = pool_timeout
+        self._pool_condition = threading.Condition()
+        self._idle = []
+        self._open_count = 0
+        self._local = threading.local()
+        self._stats = stats
+        self._pragmas = collections.OrderedDict(PROFILES[profile])
+        self._pragma_overrides = {}
+        self._pragma_generation = 0
+        self._bulk_load_count = 0
+
+        if pragmas:
+            self._pragmas.update(pragmas)
+
+    @property
+    def stats(self):
+        '''The :class:`QueryStats` or ``None``.'''
+        return self._stats
 
     @contextlib.contextmanager
     def __call__(self):
+        if not self._pool_size:
+            con = self._connect()
+
+            try:
+                with con:
+                    yield con
+            finally:
+                con.close()
+
+            return
+
+        record = self._acquire()
+
+        try:
+            with record.connection:
+                yield record.connection
+        finally:
+            self._release(record)
+
+    def _connect(self):
+        '''Open and set up a new connection.'''
         con = sqlite3.connect(self._path, **self._kwargs)
 
+        if self._stats:
+            con.stats = self._stats
+
         con.row_factory = sqlite3.Row
-        con.execute('PRAGMA synchronous=NORMAL')
-        con.execute('PRAGMA journal_mode=WAL')
-        con.execute('PRAGMA foreign_keys=ON')
+        self._apply_pragmas(con)
+
+        return con
+
+    def _apply_pragmas(self, con):
+        for name, value in self._pragmas.items():
+            value = self._pragma_overrides.get(name, value)
+            con.execute('PRAGMA {}={}'.format(name, value)).fetchall()
+
+    @contextlib.contextmanager
+    def bulk_load(self):
+        '''Use ``synchronous=OFF`` for connections used inside the ``with``
+        statement.
+
+        The previous setting is restored when the last overlapping block
+        exits. Data written inside the block may be lost if the operating
+        system crashes, but the database will not be corrupted.
+
+        Example::
+
+            with connector.bulk_load():
+                database.set_many(lots_of_items)
+
+        '''
+        with self._pool_condition:
+            self._bulk_load_count += 1
+
+            if self._bulk_load_count == 1:
+                self._pragma_overrides = {'synchronous': 'OFF'}
+                self._pragma_generation += 1
+
+        try:
+            yield
+        finally:
+            with self._pool_condition:
+                self._bulk_load_count -= 1
+
+                if not self._bulk_load_count:
+                    self._pragma_overrides = {}
+                    self._pragma_generation += 1
+
+    def _acquire(self):
+        '''Check out a connection from the pool.'''
+        deadline = None
+
+        if self._pool_timeout is not None:
+            deadline = time.time() + self._pool_timeout
+
+        with self._pool_condition:
+            while True:
+                self._evict_idle()
+
+                record = self._pop_idle()
+
+                if record:
+                    break
+
+                if self._open_count < self._pool_size:
+                    self._open_count += 1
+                    break
+
+                if deadline is None:
+                    self._pool_condition.wait()
+                else:
+                    remaining = deadline - time.time()
+
+                    if remaining <= 0:
+                        raise sqlite3.OperationalError(
+                            'Timed out waiting for a pooled connection')
 
-        with con:
-            yield con
+                    self._pool_condition.wait(remaining)
+
+        if record and not self._check_health(record):
+            # Keep the slot and open a replacement in it
+            self._close_connection(record)
+            record = None
+
+        if not record:
+            try:
+                record = _PooledConnection(self._connect(),
+                    self._pragma_generation)
+            except Exception:
+                self._discard(None)
+                raise
+        elif record.pragma_generation != self._pragma_generation:
+            try:
+                self._apply_pragmas(record.connection)
+            except Exception:
+                self._discard(record)
+                raise
+
+            record.pragma_generation = self._pragma_generation
+
+        self._local.record = record
+
+        return record
+
+    def _pop_idle(self):
+        '''Take the idle connection preferred by the current thread.'''
+        if not self._idle:
+            return
+
+        preferred = getattr(self._local, 'record', None)
+
+        if preferred is not None:
+            for index, record in enumerate(self._idle):
+                if record is preferred:
+                    return self._idle.pop(index)
+
+        return self._idle.pop()
+
+    def _evict_idle(self):
+        '''Close connections that have been idle for too long.'''
+        if self._max_idle_time is None:
+            return
+
+        cutoff = time.time() - self._max_idle_time
+
+        while self._idle and self._idle[0].last_used < cutoff:
+            record = self._idle.pop(0)
+            record.connection.close()
+            self._open_count -= 1
+
+    def _check_health(self, record):
+        '''Return whether a pooled connection is still usable.'''
+        if time.time() - record.last_used < self._health_check_interval:
+            return True
+
+        try:
+            record.connection.execute('SELECT 1').fetchone()
+        except sqlite3.Error:
+            return False
+        else:
+            return True
+
+    def _release(self, record):
+        '''Return a connection to the pool.'''
+        if record.connection.in_transaction:
+            try:
+                record.connection.rollback()
+            except Exception:
+                self._discard(record)
+                raise
+
+        record.last_used = time.time()
+
+        with self._pool_condition:
+            self._idle.append(record)
+            self._pool_condition.notify()
+
+    def _discard(self, record):
+        '''Close a connection and free its slot in the pool.'''
+        if record:
+            self._close_connection(record)
+
+        with self._pool_condition:
+            self._open_count -= 1
+            self._pool_condition.notify()
+
+    def _close_connection(self, record):
+        '''Close a pooled connection, ignoring errors.'''
+        try:
+            record.connection.close()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        '''Close all idle pooled connections.'''
+        with self._pool_condition:
+            while self._idle:
+                record = self._idle.pop()
+                record.connection.close()
+                self._open_count -= 1
+
+    def checkpoint(self, mode=PASSIVE):
+        '''Copy WAL content into the database file.
+
+        :param mode: :data:`PASSIVE`, :data:`FULL`, :data:`RESTART` or
+            :data:`TRUNCATE`.
+        :rtype: :class:`CheckpointResult`
+        '''
+        if mode not in (PASSIVE, FULL, RESTART, TRUNCATE):
+            raise ValueError('Unknown checkpoint mode {}'.format(mode))
+
+        with self() as con:
+            row = con.execute('PRAGMA wal_checkpoint({})'.format(mode)
+                ).fetchone()
+
+        return CheckpointResult(*row)
+
+    def backup(self, destination, pages_per_step=-1, progress=None,
+    step_delay=0.0):
+        '''Copy the database while it is in use.
+
+        :param destination: A file path or a :class:`Connector`.
+        :param pages_per_step: The number of pages copied at a time. ``-1``
+            copies everything in one step. In WAL mode a single step does
+            not block writers. With smaller steps, a write by another
+            connection restarts the backup, so it may not finish under
+            sustained writes.
+        :param progress: A callable called after each step with
+            ``(status, remaining, total)``.
+        :param step_delay: Seconds to sleep after each step to limit the
+            I/O used by the backup.
+        '''
+        def step_callback(status, remaining, total):
+            if progress:
+                progress(status, remaining, total)
+
+            if step_delay and remaining:
+                time.sleep(step_delay)
+
+        if isinstance(destination, Connector):
+            destination_context = destination()
+        else:
+            destination_context = contextlib.closing(
+                sqlite3.connect(destination))
+
+        with self() as con:
+            with destination_context as destination_con:
+                con.backup(destination_con, pages=pages_per_step,
+                    progress=step_callback)
 
     @property
     def database_size(self):
@@ -58,3 +647,4 @@ class Connector(object):
             page_size = cur.fetchone()[0]
 
         return page_count * page_size
+
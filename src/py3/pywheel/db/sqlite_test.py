@@ -1,8 +1,10 @@
 # This file is part of PyWheel.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
-from pywheel.db.sqlite import Connector
+from pywheel.db import sqlite
+from pywheel.db.sqlite import Connector, QueryStats
 import os.path
+import sqlite3
 import tempfile
 import time
 import unittest
@@ -27,3 +29,228 @@ class TestSqliteConnector(unittest.TestCase):
             row = cur.fetchone()
 
             self.assertEqual(row[0], 'kitteh')
+
+    def test_pool_reuse(self):
+        '''It should hand the same connection back to the same thread.'''
+
+        tempdir = tempfile.TemporaryDirectory()
+        connector = Connector(os.path.join(tempdir.name, 'kittens.db'),
+            pool_size=2)
+
+        with connector() as connection:
+            first_connection = connection
+
+        with connector() as connection:
+            self.assertIs(first_connection, connection)
+
+            with connector() as nested_connection:
+                self.assertIsNot(connection, nested_connection)
+
+        connector.close()
+
+    def test_pool_bounded(self):
+        '''It should not open more connections than the pool size.'''
+
+        tempdir = tempfile.TemporaryDirectory()
+        connector = Connector(os.path.join(tempdir.name, 'kittens.db'),
+            pool_size=1, pool_timeout=0.01)
+
+        with connector():
+            def f():
+                with connector():
+                    pass
+
+            self.assertRaises(sqlite3.OperationalError, f)
+
+    def test_pool_idle_eviction(self):
+        '''It should close connections that have been idle too long.'''
+
+        tempdir = tempfile.TemporaryDirectory()
+        connector = Connector(os.path.join(tempdir.name, 'kittens.db'),
+            pool_size=1, max_idle_time=0.01)
+
+        with connector() as connection:
+            first_connection = connection
+
+        time.sleep(0.02)
+
+        with connector() as connection:
+            self.assertIsNot(first_connection, connection)
+
+    def test_pool_broken_connection(self):
+        '''It should replace broken connections without leaking slots.'''
+
+        tempdir = tempfile.TemporaryDirectory()
+        connector = Connector(os.path.join(tempdir.name, 'kittens.db'),
+            pool_size=1, pool_timeout=0.01, health_check_interval=0)
+
+        with connector() as connection:
+            first_connection = connection
+
+        first_connection.close()
+
+        with connector() as connection:
+            second_connection = connection
+            connection.execute('SELECT 1')
+
+        self.assertIsNot(first_connection, second_connection)
+
+        connector = Connector(os.path.join(tempdir.name, 'kittens.db'),
+            pool_size=1, pool_timeout=0.01)
+
+        with connector() as connection:
+            first_connection = connection
+
+        first_connection.close()
+
+        with connector.bulk_load():
+            def f():
+                with connector():
+                    pass
+
+            self.assertRaises(sqlite3.ProgrammingError, f)
+
+            with connector() as connection:
+                connection.execute('SELECT 1')
+
+        connector.close()
+
+    def test_stats(self):
+        '''It should record statement timings and rows.'''
+
+        tempdir = tempfile.TemporaryDirectory()
+        stats = QueryStats(slow_query_threshold=0)
+        connector = Connector(os.path.join(tempdir.name, 'kittens.db'),
+            stats=stats)
+
+        with connector() as connection:
+            connection.execute('CREATE TABLE kittens '
+                '(id INTEGER PRIMARY KEY, name TEXT)')
+            connection.executemany('INSERT INTO kittens (name) VALUES (?)',
+                [['kitteh'], ['cat']])
+
+        with self.assertLogs('pywheel.db.sqlite', 'WARNING'):
+            with connector() as connection:
+                rows = list(connection.execute('SELECT name FROM kittens'))
+
+        self.assertEqual(2, len(rows))
+
+        statement_stats = stats.statements['SELECT name FROM kittens']
+
+        self.assertEqual(1, statement_stats.count)
+        self.assertEqual(2, statement_stats.rows)
+        self.assertEqual(1, sum(statement_stats.histogram))
+        self.assertTrue(stats.top(1))
+
+    def test_stats_fetch_time(self):
+        '''It should include the time to fetch rows.'''
+
+        tempdir = tempfile.TemporaryDirectory()
+        stats = QueryStats()
+        connector = Connector(os.path.join(tempdir.name, 'kittens.db'),
+            stats=stats)
+
+        def slow(value):
+            time.sleep(0.01)
+            return value
+
+        with connector() as connection:
+            connection.create_function('slow', 1, slow)
+            connection.execute('CREATE TABLE kittens '
+                '(id INTEGER PRIMARY KEY, name TEXT)')
+            connection.executemany('INSERT INTO kittens (name) VALUES (?)',
+                [['kitteh'], ['cat'], ['meow']])
+
+            for row in connection.execute('SELECT slow(name) FROM kittens'):
+                pass
+
+            connection.execute('SELECT name FROM kittens').fetchone()
+
+        statement_stats = stats.statements['SELECT slow(name) FROM kittens']
+
+        self.assertEqual(1, statement_stats.count)
+        self.assertEqual(3, statement_stats.rows)
+        self.assertGreaterEqual(statement_stats.total_time, 0.03)
+
+        statement_stats = stats.statements['SELECT name FROM kittens']
+
+        self.assertEqual(1, statement_stats.count)
+        self.assertEqual(1, statement_stats.rows)
+
+    def test_profile(self):
+        '''It should apply the profile and bulk load settings.'''
+
+        tempdir = tempfile.TemporaryDirectory()
+        connector = Connector(os.path.join(tempdir.name, 'kittens.db'),
+            pool_size=1, profile='read_heavy', pragmas={'cache_size': -1024})
+
+        def get_pragma(name):
+            with connector() as connection:
+                return connection.execute('PRAGMA ' + name).fetchone()[0]
+
+        self.assertEqual(-1024, get_pragma('cache_size'))
+        self.assertEqual(2, get_pragma('temp_store'))
+        self.assertEqual(1, get_pragma('synchronous'))
+
+        with connector.bulk_load():
+            self.assertEqual(0, get_pragma('synchronous'))
+
+        self.assertEqual(1, get_pragma('synchronous'))
+
+    def test_bulk_load_overlapping(self):
+        '''It should restore the setting after overlapping bulk loads.'''
+
+        tempdir = tempfile.TemporaryDirectory()
+        connector = Connector(os.path.join(tempdir.name, 'kittens.db'),
+            pool_size=1)
+
+        def get_pragma(name):
+            with connector() as connection:
+                return connection.execute('PRAGMA ' + name).fetchone()[0]
+
+        first_scope = connector.bulk_load()
+        second_scope = connector.bulk_load()
+
+        first_scope.__enter__()
+        second_scope.__enter__()
+        first_scope.__exit__(None, None, None)
+
+        self.assertEqual(0, get_pragma('synchronous'))
+
+        second_scope.__exit__(None, None, None)
+
+        self.assertEqual(1, get_pragma('synchronous'))
+
+        connector.close()
+
+    def test_backup_and_checkpoint(self):
+        '''It should copy the database and checkpoint the WAL.'''
+
+        tempdir = tempfile.TemporaryDirectory()
+        connector = Connector(os.path.join(tempdir.name, 'kittens.db'))
+
+        with connector() as connection:
+            connection.execute('CREATE TABLE kittens '
+                '(id INTEGER PRIMARY KEY, name TEXT)')
+            connection.executemany('INSERT INTO kittens (name) VALUES (?)',
+                [['kitteh{}'.format(i)] for i in range(1000)])
+
+        steps = []
+        backup_path = os.path.join(tempdir.name, 'backup.db')
+        connector.backup(backup_path, pages_per_step=1,
+            progress=lambda *args: steps.append(args))
+
+        self.assertGreater(len(steps), 1)
+
+        backup_connector = Connector(backup_path)
+
+        with backup_connector() as connection:
+            cur = connection.execute('SELECT COUNT(*) FROM kittens')
+
+            self.assertEqual(1000, cur.fetchone()[0])
+
+        result = connector.checkpoint(sqlite.TRUNCATE)
+
+        self.assertEqual(0, result.busy)
+        self.assertRaises(ValueError, connector.checkpoint, 'KITTENS')
+
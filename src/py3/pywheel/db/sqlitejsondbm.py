@@ -2,25 +2,151 @@
 # This file is part of PyWheel.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
+from pywheel.cache import LRUCache
+from pywheel.db import codec as codec_
 from pywheel.db.sqlite import Connector
 import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import hashlib
+import heapq
+import itertools
 import json
+import logging
+import re
+import threading
+import time
+import zlib
 
+_logger = logging.getLogger(__name__)
 
-class Database(collections.MutableMapping):
+_MISSING = object()
+
+_UPSERT = ('INSERT INTO t (k, c, v, x) VALUES ( ?, ?, ?, ? ) '
+    'ON CONFLICT(k) DO UPDATE SET c = excluded.c, v = excluded.v, '
+    'x = excluded.x')
+
+_LIVE = '(x IS NULL OR x > ?)'
+
+_INDEX_NAME_PATTERN = re.compile(r'^\w+$')
+
+_PATH_TOKEN_PATTERN = re.compile(
+    r'\.([^.\[\]"]+)|\."((?:[^"\\]|\\.)*)"|\[(\d+)\]')
+
+SweepResult = collections.namedtuple('SweepResult',
+    ['deleted', 'size_before', 'size_after'])
+'''The result of :meth:`Database.sweep`'''
+
+
+class Database(collections.abc.MutableMapping):
     '''A dict-like object that uses SQLite as the storage'''
 
-    def __init__(self, path):
-        self._connector = Connector(path)
+    CHUNK_SIZE = 500
+    '''Maximum number of keys bound to a single ``IN (...)`` query'''
+
+    FETCH_SIZE = 1000
+    '''Number of rows fetched per query while iterating'''
+
+    DATA_VERSION_CONNECTIONS = 64
+    '''Maximum number of connections tracked for ``PRAGMA data_version``'''
+
+    def __init__(self, path, pool_size=4, cache_items=None, cache_bytes=None,
+    watch_data_version=False, codec=None, compress_threshold=None,
+    default_ttl=None, **connector_kwargs):
+        '''Open the database.
+
+        :param pool_size: The number of pooled connections.
+            See :class:`.Connector`.
+        :param cache_items: If given, decoded values are kept in a
+            :class:`.LRUCache` of at most this many entries.
+        :param cache_bytes: If given, decoded values are kept in a
+            :class:`.LRUCache` of at most this many bytes of encoded data.
+        :param watch_data_version: If ``True``, the cache is cleared
+            whenever ``PRAGMA data_version`` shows that another connection,
+            including one in another process, changed the database. This
+            needs pooled connections to be effective.
+        :param codec: The :class:`.codec.Codec` used to write values.
+            The default is :class:`.codec.JSONCodec`. Values are read back
+            with the codec that wrote them. A custom codec needs a tag that
+            is not used by :data:`.codec.CODECS`, and a database it wrote
+            must be opened with it.
+        :param compress_threshold: If given, encoded values longer than this
+            many bytes are compressed with zlib.
+        :param default_ttl: If given, values stored without a TTL expire
+            after this many seconds.
+
+        Values returned from the cache are shared and must not be modified
+        in place. Written values are cached as decoded copies, so the
+        caller may keep modifying the object it stored.
+        '''
+        self._connector = Connector(path, pool_size=pool_size,
+            **connector_kwargs)
+        self._local = threading.local()
+        self._cache = None
+        self._watch_data_version = watch_data_version
+        self._data_versions = {}
+        self._data_versions_lock = threading.Lock()
+        self._codec = codec or codec_.JSONCodec()
+        self._codecs = dict(codec_.CODECS)
+        tag = self._codec.tag
+        registered_codec = self._codecs.get(tag)
+
+        if not isinstance(tag, int) or not 0 <= tag < codec_.COMPRESSED \
+        or registered_codec is not None \
+        and type(registered_codec) is not type(self._codec):
+            raise ValueError('Codec tag {!r} is not valid or is used by '
+                'another codec'.format(tag))
+
+        self._codecs[tag] = self._codec
+        self._compress_threshold = compress_threshold
+        self._default_ttl = default_ttl
+        self._indexes = {}
+
+        if cache_items or cache_bytes:
+            self._cache = LRUCache(cache_items, cache_bytes)
+
+        with self._connector() as connection:
+            table_count = connection.execute(
+                'SELECT COUNT(*) FROM sqlite_master').fetchone()[0]
+
+            if not table_count:
+                connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                connection.execute('VACUUM')
 
         with self._connector() as connection:
+            connection.execute('BEGIN IMMEDIATE')
             connection.execute('CREATE TABLE IF NOT EXISTS '
-                't(k TEXT PRIMARY KEY, v TEXT)'
+                't(k TEXT PRIMARY KEY, v TEXT, c INTEGER NOT NULL DEFAULT 0)'
             )
 
+            columns = [row[1] for row in
+                connection.execute('PRAGMA table_info(t)')]
+
+            if 'c' not in columns:
+                connection.execute('ALTER TABLE t '
+                    'ADD COLUMN c INTEGER NOT NULL DEFAULT 0')
+
+            if 'x' not in columns:
+                connection.execute('ALTER TABLE t ADD COLUMN x REAL')
+
+            connection.execute('CREATE INDEX IF NOT EXISTS t_x ON t(x) '
+                'WHERE x IS NOT NULL')
+
+            connection.execute('CREATE TABLE IF NOT EXISTS '
+                't_count(n INTEGER NOT NULL)')
+            connection.execute('INSERT INTO t_count (n) '
+                'SELECT COUNT(*) FROM t '
+                'WHERE NOT EXISTS (SELECT 1 FROM t_count)')
+            connection.execute('CREATE TRIGGER IF NOT EXISTS t_count_insert '
+                'AFTER INSERT ON t BEGIN UPDATE t_count SET n = n + 1; END')
+            connection.execute('CREATE TRIGGER IF NOT EXISTS t_count_delete '
+                'AFTER DELETE ON t BEGIN UPDATE t_count SET n = n - 1; END')
+
     def __len__(self):
-        with self._connector() as connection:
-            cursor = connection.execute('SELECT SUM(1) FROM t')
+        with self._connection() as connection:
+            cursor = connection.execute('SELECT n - (SELECT COUNT(*) FROM t '
+                'WHERE x IS NOT NULL AND x <= ?) FROM t_count', [time.time()])
             row = cursor.fetchone()
 
             if row and row[0]:
@@ -29,24 +155,125 @@ class Database(collections.MutableMapping):
                 return 0
 
     def keys(self):
-        return list(self.__iter__())
+        return _KeysView(self)
+
+    def values(self):
+        return _ValuesView(self)
+
+    def items(self):
+        return _ItemsView(self)
 
     def __iter__(self):
-        with self._connector() as connection:
-            cursor = connection.execute('SELECT k FROM t')
+        return self.iterkeys()
+
+    def iterkeys(self, prefix=None, start=None, stop=None, batch_size=None):
+        '''Iterate the keys in sorted order.
+
+        Rows are fetched lazily in batches using the primary key index.
+
+        :param prefix: If given, only keys starting with the prefix.
+        :param start: If given, only keys greater than or equal to it.
+        :param stop: If given, only keys less than it.
+        :param batch_size: The number of rows per query. The default is
+            :attr:`FETCH_SIZE`.
+        '''
+        for row in self._scan('k', prefix, start, stop, batch_size):
+            yield row[0]
+
+    def itervalues(self, prefix=None, start=None, stop=None,
+    batch_size=None):
+        '''Iterate the values in key order.
+
+        The parameters are the same as :meth:`iterkeys`.
+        '''
+        for row in self._scan('k, c, v', prefix, start, stop, batch_size):
+            yield self._decode(row[1], row[2])
+
+    def iteritems(self, prefix=None, start=None, stop=None,
+    batch_size=None):
+        '''Iterate ``(key, value)`` pairs in key order.
+
+        The parameters are the same as :meth:`iterkeys`.
+        '''
+        for row in self._scan('k, c, v', prefix, start, stop, batch_size):
+            yield row[0], self._decode(row[1], row[2])
+
+    def _iteritems_expiry(self, batch_size=None):
+        '''Iterate ``(key, value, expiry time)`` in key order.'''
+        for row in self._scan('k, c, v, x', None, None, None, batch_size):
+            yield row[0], self._decode(row[1], row[2]), row[3]
+
+    def _scan(self, columns, prefix, start, stop, batch_size):
+        '''Yield rows in key order using keyset pagination.
+
+        A connection is only held while a batch is fetched so long
+        iterations do not pin a read transaction.
+        '''
+        batch_size = batch_size or self.FETCH_SIZE
+
+        if prefix:
+            if start is None or prefix > start:
+                start = prefix
+
+            prefix_stop = _prefix_successor(prefix)
+
+            if stop is None or prefix_stop is not None and prefix_stop < stop:
+                stop = prefix_stop
+
+        lower_operator = '>='
 
-            for row in cursor:
-                yield row[0]
+        while True:
+            conditions = [_LIVE]
+            params = [time.time()]
+
+            if start is not None:
+                conditions.append('k {} ?'.format(lower_operator))
+                params.append(start)
+
+            if stop is not None:
+                conditions.append('k < ?')
+                params.append(stop)
+
+            query = 'SELECT {} FROM t WHERE {} ORDER BY k LIMIT ?'.format(
+                columns, ' AND '.join(conditions))
+            params.append(batch_size)
+
+            with self._connection() as connection:
+                rows = connection.execute(query, params).fetchall()
+
+            for row in rows:
+                yield row
+
+            if len(rows) < batch_size:
+                break
+
+            start = rows[-1][0]
+            lower_operator = '>'
 
     def __getitem__(self, k):
-        with self._connector() as connection:
-            cursor = connection.execute('SELECT v FROM t WHERE k = ?', [k])
+        cache = self._readable_cache()
+
+        if cache is not None:
+            generation = cache.generation
+            entry = cache.get(k, _MISSING)
+
+            if entry is not _MISSING and _is_live(entry[1]):
+                return entry[0]
+
+        with self._connection() as connection:
+            cursor = connection.execute('SELECT c, v, x FROM t '
+                'WHERE k = ? AND ' + _LIVE, [k, time.time()])
             row = cursor.fetchone()
 
-            if row:
-                return json.loads(row[0])
-            else:
-                raise IndexError()
+        if not row:
+            raise IndexError()
+
+        value = self._decode(row[0], row[1])
+
+        if cache is not None:
+            cache.put(k, (value, row[2]), len(row[1]), generation)
+
+        return value
 
     def __contains__(self, k):
         try:
@@ -56,15 +283,1001 @@ class Database(collections.MutableMapping):
             return False
 
     def __setitem__(self, k, v):
-        with self._connector() as connection:
-            connection.execute('INSERT OR REPLACE INTO t (k, v) '
-                'VALUES ( ?, ? )', [k, json.dumps(v)])
+        self.set(k, v)
+
+    def set(self, k, v, ttl=None):
+        '''Store a value.
+
+        :param ttl: If given, the value expires after this many seconds.
+            The default is the `default_ttl` of the database.
+        '''
+        tag, data = self._encode(v)
+        expires = self._expiry(ttl)
+        cache = self._cache
+
+        if cache is not None:
+            generation = cache.generation
+
+        with self._connection() as connection:
+            connection.execute(_UPSERT, [k, tag, data, expires])
+
+            if self._indexes:
+                self._reindex(connection, [(k, v)])
+
+        if cache is not None:
+            self._invalidate(k)
+
+            if not self._in_transaction():
+                cache.put(k, (self._decode(tag, data), expires), len(data),
+                    generation + 1)
 
     def __delitem__(self, k):
-        with self._connector() as connection:
+        with self._connection() as connection:
             connection.execute('DELETE FROM t WHERE k = ? ', [k])
 
+        self._invalidate(k)
+
+    def get_many(self, keys):
+        '''Return a ``dict`` of the values for the given keys.
+
+        Keys that do not exist are omitted from the result.
+
+        :param keys: An iterable of keys.
+        '''
+        result = {}
+        cache = self._readable_cache()
+
+        if cache is not None:
+            generation = cache.generation
+            keys = self._get_cached(cache, keys, result)
+
+        with self._connection() as connection:
+            for chunk in _chunks(keys, self.CHUNK_SIZE):
+                cursor = connection.execute('SELECT k, c, v, x FROM t '
+                    'WHERE k IN ({}) AND {}'.format(
+                        ', '.join('?' * len(chunk)), _LIVE),
+                    chunk + [time.time()])
+
+                for row in cursor:
+                    value = self._decode(row[1], row[2])
+                    result[row[0]] = value
+
+                    if cache is not None:
+                        cache.put(row[0], (value, row[3]), len(row[2]),
+                            generation)
+
+        return result
+
+    def _get_cached(self, cache, keys, result):
+        '''Put cached values into `result` and yield the missing keys.'''
+        for k in keys:
+            entry = cache.get(k, _MISSING)
+
+            if entry is not _MISSING and _is_live(entry[1]):
+                result[k] = entry[0]
+            else:
+                yield k
+
+    def set_many(self, items, ttl=None):
+        '''Store many values in one transaction.
+
+        :param items: A mapping or an iterable of ``(key, value)`` pairs.
+            Iterables are consumed lazily.
+        :param ttl: See :meth:`set`.
+        '''
+        if isinstance(items, collections.abc.Mapping):
+            items = items.items()
+
+        expires = self._expiry(ttl)
+
+        self._set_many_expiry((k, v, expires) for k, v in items)
+
+    def _set_many_expiry(self, items):
+        '''Store ``(key, value, expiry time)`` items in one transaction.'''
+        try:
+            with self._connection() as connection:
+                if not self._indexes:
+                    connection.executemany(_UPSERT, ((self._written(k),) +
+                        self._encode(v) + (expires,)
+                        for k, v, expires in items))
+                    return
+
+                for chunk in _chunks(items, self.CHUNK_SIZE):
+                    connection.executemany(_UPSERT, ((self._written(k),) +
+                        self._encode(v) + (expires,)
+                        for k, v, expires in chunk))
+                    self._reindex(connection,
+                        [(k, v) for k, v, expires in chunk])
+        finally:
+            self._invalidate_written()
+
+    def delete_many(self, keys):
+        '''Delete many keys in one transaction.
+
+        Keys that do not exist are ignored.
+
+        :param keys: An iterable of keys. Iterables are consumed lazily.
+        '''
+        try:
+            with self._connection() as connection:
+                connection.executemany('DELETE FROM t WHERE k = ?',
+                    ((self._written(k),) for k in keys))
+        finally:
+            self._invalidate_written()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Group operations into one transaction using the ``with``
+        statement.
+
+        Operations done by the current thread inside the block share one
+        connection and are committed once at the end. If an exception
+        is raised, they are rolled back. The write lock is taken at the
+        start so reads inside the block are not stale.
+
+        Transactions can be nested. A nested block is rolled back on its
+        own if an exception leaves it.
+
+        Example::
+
+            with db.transaction():
+                db['a'] = 1
+                db['b'] = 2
+
+        '''
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is not None:
+            self._local.depth += 1
+            savepoint = 'sp{}'.format(self._local.depth)
+            connection.execute('SAVEPOINT ' + savepoint)
+
+            try:
+                yield self
+            except Exception:
+                connection.execute('ROLLBACK TO ' + savepoint)
+                connection.execute('RELEASE ' + savepoint)
+                raise
+            else:
+                connection.execute('RELEASE ' + savepoint)
+            finally:
+                self._local.depth -= 1
+
+            return
+
+        try:
+            with self._connector() as connection:
+                connection.execute('BEGIN IMMEDIATE')
+                self._local.connection = connection
+                self._local.depth = 0
+
+                try:
+                    yield self
+                finally:
+                    self._local.connection = None
+        finally:
+            self._invalidate_written()
+
+    def _in_transaction(self):
+        return getattr(self._local, 'connection', None) is not None
+
+    @contextlib.contextmanager
+    def _connection(self):
+        '''Return the connection of the current transaction or a new one.'''
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is not None:
+            yield connection
+        else:
+            with self._connector() as connection:
+                yield connection
+
+    def purge_expired(self, batch_size=500, pause=0.0):
+        '''Delete expired keys.
+
+        Keys are deleted in small transactions so readers and writers are
+        not blocked for long.
+
+        :param batch_size: The number of keys deleted per transaction.
+        :param pause: Seconds to sleep between transactions.
+        :returns: The number of deleted keys.
+        '''
+        deleted = 0
+
+        while True:
+            with self._connection() as connection:
+                cursor = connection.execute('DELETE FROM t WHERE k IN '
+                    '(SELECT k FROM t WHERE x IS NOT NULL AND x <= ? '
+                    'LIMIT ?)', [time.time(), batch_size])
+
+            deleted += cursor.rowcount
+
+            if cursor.rowcount < batch_size:
+                break
+
+            if pause:
+                time.sleep(pause)
+
+        return deleted
+
+    def sweep(self, batch_size=500, pause=0.0, vacuum_pages=1000):
+        '''Purge expired keys and give unused space back to the system.
+
+        Runs :meth:`purge_expired`, ``PRAGMA incremental_vacuum`` and a
+        passive ``PRAGMA wal_checkpoint``.
+
+        :param vacuum_pages: The maximum number of free pages to release.
+            Databases created before incremental vacuum was enabled do not
+            release pages until they are vacuumed.
+        :rtype: :class:`SweepResult`
+        '''
+        size_before = self._connector.database_size
+        deleted = self.purge_expired(batch_size, pause)
+
+        with self._connector() as connection:
+            connection.execute('PRAGMA incremental_vacuum({})'.format(
+                int(vacuum_pages))).fetchall()
+
+        self._connector.checkpoint()
+
+        size_after = self._connector.database_size
+
+        _logger.debug('Swept %d expired keys. Size %d → %d bytes.',
+            deleted, size_before, size_after)
+
+        return SweepResult(deleted, size_before, size_after)
+
+    def _expiry(self, ttl):
+        '''Return the expiry timestamp for a TTL.'''
+        if ttl is None:
+            ttl = self._default_ttl
+
+        if ttl is not None:
+            return time.time() + ttl
+
+    def _encode(self, v):
+        '''Return the codec tag and encoded data of a value.'''
+        return codec_.encode(self._codec, v, self._compress_threshold)
+
+    def _decode(self, tag, data):
+        '''Return a value encoded by :meth:`_encode` or another codec.'''
+        return codec_.decode(tag, data, self._codecs)
+
+    @property
+    def connector(self):
+        '''The :class:`.Connector`.'''
+        return self._connector
+
+    @property
+    def cache(self):
+        '''The :class:`.LRUCache` of decoded values or ``None``.'''
+        return self._cache
+
+    def _readable_cache(self):
+        '''Return the cache if it may be used for reads by this thread.
+
+        Reads inside a transaction may see uncommitted data so they bypass
+        the cache.
+        '''
+        if self._cache is None or self._in_transaction():
+            return
+
+        if self._watch_data_version:
+            with self._connector() as connection:
+                self._check_data_version(connection)
+
+        return self._cache
+
+    def _check_data_version(self, connection):
+        '''Clear the cache if the database was changed by another
+        connection.'''
+        version = connection.execute('PRAGMA data_version').fetchone()[0]
+
+        with self._data_versions_lock:
+            entry = self._data_versions.get(id(connection))
+
+            if entry and entry[0] is connection and entry[1] == version:
+                return
+
+            if len(self._data_versions) >= self.DATA_VERSION_CONNECTIONS:
+                self._data_versions.clear()
+
+            self._data_versions[id(connection)] = (connection, version)
+
+        self._cache.clear()
+
+    def _invalidate(self, k):
+        '''Remove a written key from the cache once it is committed.'''
+        if self._cache is None:
+            return
+
+        if self._in_transaction():
+            self._written(k)
+        else:
+            self._cache.discard(k)
+
+    def _written(self, k):
+        '''Record a key written by a bulk operation or a transaction.'''
+        if self._cache is not None:
+            written = getattr(self._local, 'written', None)
+
+            if written is None:
+                written = self._local.written = set()
+
+            written.add(k)
+
+        return k
+
+    def _invalidate_written(self):
+        '''Remove recorded keys from the cache once they are committed.'''
+        written = getattr(self._local, 'written', None)
+
+        if not written or self._in_transaction():
+            return
+
+        self._local.written = None
+
+        if len(written) > len(self._cache):
+            self._cache.clear()
+        else:
+            for k in written:
+                self._cache.discard(k)
+
+    def close(self):
+        '''Close the pooled connections.'''
+        self._connector.close()
+
+    def update(self, k, v):
+        '''Update the ``dict`` stored at `k` with `v` atomically.'''
+        with self.transaction():
+            d = self[k]
+            d.update(v)
+            self[k] = d
+
+    def get_path(self, k, path, default=None):
+        '''Return part of a value using a JSON path such as ``$.a.b[0]``.
+
+        For JSON values, the part is extracted by SQLite so only it is
+        decoded.
+
+        :param default: Returned if the path does not exist.
+        '''
+        with self._connection() as connection:
+            cursor = connection.execute('SELECT c, '
+                'CASE WHEN c = 0 THEN json_type(v, ?) ELSE v END, '
+                'CASE WHEN c = 0 THEN json_extract(v, ?) END '
+                'FROM t WHERE k = ? AND ' + _LIVE,
+                [path, path, k, time.time()])
+            row = cursor.fetchone()
+
+        if not row:
+            raise IndexError()
+
+        if row[0] != codec_.JSONCodec.tag:
+            return _get_path(self._decode(row[0], row[1]), path, default)
+
+        json_type = row[1]
+
+        if json_type is None:
+            return default
+        elif json_type in ('object', 'array'):
+            return json.loads(row[2])
+        elif json_type in ('true', 'false'):
+            return json_type == 'true'
+        else:
+            return row[2]
+
+    def update_paths(self, k, paths):
+        '''Set parts of a value using JSON paths.
+
+        For JSON values, the value is changed by SQLite's ``json_set`` so
+        it is not decoded. Like ``json_set``, parents of a path are not
+        created.
+
+        :param paths: A mapping of JSON path to new value.
+        '''
+        paths = list(paths.items())
+        arguments = []
+
+        for path, value in paths:
+            arguments.extend((path, json.dumps(value)))
+
+        self._update_json(k, 'json_set(v{})'.format(
+            ', ?, json(?)' * len(paths)), arguments,
+            lambda value: _set_paths(value, paths))
+
+    def patch(self, k, patch):
+        '''Apply a RFC 7396 JSON merge patch to a value.
+
+        Nested objects are merged and ``None`` deletes a member. For JSON
+        values, the patch is applied by SQLite's ``json_patch``.
+        '''
+        self._update_json(k, 'json_patch(v, json(?))', [json.dumps(patch)],
+            lambda value: _merge_patch(value, patch))
+
+    def _update_json(self, k, expression, arguments, function):
+        '''Change a value with an SQL JSON expression or, for values that
+        are not uncompressed JSON, a Python function.'''
+        with self.transaction():
+            with self._connection() as connection:
+                cursor = connection.execute('UPDATE t SET v = {} '
+                    'WHERE k = ? AND c = 0 AND {}'.format(expression, _LIVE),
+                    arguments + [k, time.time()])
+
+                if not cursor.rowcount:
+                    value = function(self[k])
+                    tag, data = self._encode(value)
+                    connection.execute('UPDATE t SET c = ?, v = ? '
+                        'WHERE k = ?', [tag, data, k])
+                elif self._indexes:
+                    value = self[k]
+
+                if self._indexes:
+                    self._reindex(connection, [(k, value)])
+
+            self._invalidate(k)
+
+    def create_path_index(self, path):
+        '''Create an index on a JSON path of the values.
+
+        The index makes :meth:`find_path` fast for the path. It only
+        covers values stored as uncompressed JSON.
+        '''
+        with self._connection() as connection:
+            connection.execute('CREATE INDEX IF NOT EXISTS "{}" '
+                'ON t(json_extract(v, {})) WHERE c = 0'.format(
+                    _path_index_name(path), _quote(path)))
+
+    def drop_path_index(self, path):
+        '''Drop an index created by :meth:`create_path_index`.'''
+        with self._connection() as connection:
+            connection.execute('DROP INDEX IF EXISTS "{}"'.format(
+                _path_index_name(path)))
+
+    def find_path(self, path, value):
+        '''Iterate the keys of JSON values whose part at `path` equals
+        `value`.
+
+        Only values stored as uncompressed JSON are searched.
+        '''
+        with self._connection() as connection:
+            rows = connection.execute('SELECT k FROM t '
+                'WHERE c = 0 AND json_extract(v, {}) = ? AND {} '
+                'ORDER BY k'.format(_quote(path), _LIVE),
+                [value, time.time()]).fetchall()
+
+        for row in rows:
+            yield row[0]
+
+    def add_index(self, name, path=None, function=None):
+        '''Declare a secondary index kept in sync on write.
+
+        Index entries are stored in a side table named ``i_`` + `name`.
+        If the table does not exist, it is created and filled from the
+        existing values.
+
+        :param name: A name made of letters, digits and underscores.
+        :param path: A JSON path such as ``$.user_id`` of the indexed part
+            of the values.
+        :param function: Instead of `path`, a callable that takes a value
+            and returns the indexed value. If it returns ``None``, the value
+            is not indexed. If it returns a ``list``, ``tuple`` or ``set``,
+            every item is indexed.
+
+        .. note::
+
+            Every process writing to the database must declare the same
+            indexes. Deletions are always reflected because index entries
+            are removed by a foreign key cascade.
+        '''
+        if not _INDEX_NAME_PATTERN.match(name):
+            raise ValueError('Index name must be letters, digits or _')
+
+        if (path is None) == (function is None):
+            raise ValueError('Either path or function is required')
+
+        if path is not None:
+            _parse_path(path)
+            function = lambda value: _get_path(value, path)
+
+        with self.transaction():
+            with self._connection() as connection:
+                exists = connection.execute('SELECT 1 FROM sqlite_master '
+                    'WHERE type = ? AND name = ?',
+                    ['table', 'i_' + name]).fetchone()
+
+                if not exists:
+                    connection.execute('CREATE TABLE "i_{0}" (v, '
+                        'k TEXT NOT NULL REFERENCES t(k) ON DELETE CASCADE, '
+                        'PRIMARY KEY (v, k)) WITHOUT ROWID'.format(name))
+                    connection.execute('CREATE INDEX "i_{0}_k" '
+                        'ON "i_{0}"(k)'.format(name))
+
+                self._indexes[name] = function
+
+                if not exists:
+                    for chunk in _chunks(self.iteritems(), self.CHUNK_SIZE):
+                        self._reindex(connection, chunk, [name])
+
+    def rebuild_index(self, name):
+        '''Rebuild the entries of an index from the values.'''
+        with self.transaction():
+            with self._connection() as connection:
+                connection.execute('DELETE FROM "i_{}"'.format(name))
+
+                for chunk in _chunks(self.iteritems(), self.CHUNK_SIZE):
+                    self._reindex(connection, chunk, [name])
+
+    def drop_index(self, name):
+        '''Forget an index and drop its side table.'''
+        self._indexes.pop(name, None)
+
+        with self._connection() as connection:
+            connection.execute('DROP TABLE IF EXISTS "i_{}"'.format(name))
+
+    @property
+    def indexes(self):
+        '''The names of the declared indexes.'''
+        return frozenset(self._indexes)
+
+    def _reindex(self, connection, items, names=None):
+        '''Replace the index entries of ``(key, value)`` pairs.'''
+        for name in names or self._indexes:
+            function = self._indexes[name]
+            connection.executemany('DELETE FROM "i_{}" WHERE k = ?'.format(
+                name), ((k,) for k, v in items))
+            connection.executemany('INSERT OR IGNORE INTO "i_{}" (v, k) '
+                'VALUES (?, ?)'.format(name),
+                _index_entries(function, items))
+
+    def find(self, name, value):
+        '''Iterate, in key order, the keys whose indexed value equals
+        `value`.
+
+        :param name: The name of an index declared with :meth:`add_index`.
+        '''
+        return self._find(name, 'i.v = ?', [value], 'i.k')
+
+    def find_range(self, name, start=None, stop=None):
+        '''Iterate, in index order, the keys whose indexed value is within
+        a range.
+
+        :param start: If given, only values greater than or equal to it.
+        :param stop: If given, only values less than it.
+        '''
+        conditions = []
+        params = []
+
+        if start is not None:
+            conditions.append('i.v >= ?')
+            params.append(start)
+
+        if stop is not None:
+            conditions.append('i.v < ?')
+            params.append(stop)
+
+        return self._find(name, ' AND '.join(conditions) or '1', params,
+            'i.v, i.k')
+
+    def _find(self, name, condition, params, order):
+        if name not in self._indexes:
+            raise KeyError(name)
+
+        with self._connection() as connection:
+            rows = connection.execute('SELECT i.k FROM "i_{}" AS i '
+                'JOIN t ON t.k = i.k WHERE {} AND {} ORDER BY {}'.format(
+                    name, condition, _LIVE, order),
+                params + [time.time()]).fetchall()
+
+        for row in rows:
+            yield row[0]
+
+
+class ShardedDatabase(collections.abc.MutableMapping):
+    '''A dict-like object that spreads keys over several SQLite files
+
+    SQLite allows one writer per file. Spreading keys lets bulk operations
+    write to each shard in parallel.
+
+    Example::
+
+        db = ShardedDatabase(['/tmp/kittens{}.db'.format(i)
+            for i in range(4)])
+
+    .. note::
+
+        Bulk operations are atomic per shard only.
+    '''
+
+    BATCH_SIZE = 10000
+    '''Number of items split across shards per round of :meth:`set_many`'''
+
+    def __init__(self, paths, workers=None, **database_kwargs):
+        '''Open the shards.
+
+        :param paths: The file paths of the shards. The order must stay the
+            same each time the database is opened. Use :func:`reshard` to
+            change the number of shards.
+        :param workers: The number of threads for bulk operations. The
+            default is one per shard.
+
+        Other arguments are passed to :class:`Database`.
+        '''
+        self._shards = [Database(path, **database_kwargs) for path in paths]
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            workers or len(self._shards))
+
+    @property
+    def shards(self):
+        '''The list of :class:`Database`.'''
+        return self._shards
+
+    def shard(self, k):
+        '''Return the :class:`Database` that stores a key.'''
+        return self._shards[self._shard_index(k)]
+
+    def _shard_index(self, k):
+        return zlib.crc32(k.encode('utf-8')) % len(self._shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def keys(self):
+        return _KeysView(self)
+
+    def values(self):
+        return _ValuesView(self)
+
+    def items(self):
+        return _ItemsView(self)
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self, *args, **kwargs):
+        '''Iterate the keys of all shards in sorted order.
+
+        See :meth:`Database.iterkeys`.
+        '''
+        return heapq.merge(*[shard.iterkeys(*args, **kwargs)
+            for shard in self._shards])
+
+    def itervalues(self, *args, **kwargs):
+        '''Iterate the values of all shards in key order.
+
+        See :meth:`Database.itervalues`.
+        '''
+        for dummy, v in self.iteritems(*args, **kwargs):
+            yield v
+
+    def iteritems(self, *args, **kwargs):
+        '''Iterate the ``(key, value)`` pairs of all shards in key order.
+
+        See :meth:`Database.iteritems`.
+        '''
+        return heapq.merge(*[shard.iteritems(*args, **kwargs)
+            for shard in self._shards])
+
+    def _iteritems_expiry(self, batch_size=None):
+        return heapq.merge(*[shard._iteritems_expiry(batch_size)
+            for shard in self._shards])
+
+    def __getitem__(self, k):
+        return self.shard(k)[k]
+
+    def __contains__(self, k):
+        return k in self.shard(k)
+
+    def __setitem__(self, k, v):
+        self.shard(k)[k] = v
+
+    def set(self, k, v, ttl=None):
+        '''See :meth:`Database.set`.'''
+        self.shard(k).set(k, v, ttl)
+
+    def __delitem__(self, k):
+        del self.shard(k)[k]
+
     def update(self, k, v):
-        d = self[k]
-        d.update(v)
-        self[k] = d
+        '''See :meth:`Database.update`.'''
+        self.shard(k).update(k, v)
+
+    def get_many(self, keys):
+        '''See :meth:`Database.get_many`.'''
+        result = {}
+
+        for values in self._map_shards(Database.get_many,
+        self._partition((k, k) for k in keys)):
+            result.update(values)
+
+        return result
+
+    def set_many(self, items, ttl=None):
+        '''See :meth:`Database.set_many`.
+
+        The items are consumed :attr:`BATCH_SIZE` at a time.
+        '''
+        if isinstance(items, collections.abc.Mapping):
+            items = items.items()
+
+        for chunk in _chunks(items, self.BATCH_SIZE):
+            list(self._map_shards(Database.set_many, self._partition(
+                (k, (k, v)) for k, v in chunk), ttl))
+
+    def _set_many_expiry(self, items):
+        for chunk in _chunks(items, self.BATCH_SIZE):
+            list(self._map_shards(Database._set_many_expiry, self._partition(
+                (item[0], item) for item in chunk)))
+
+    def delete_many(self, keys):
+        '''See :meth:`Database.delete_many`.
+
+        The keys are consumed :attr:`BATCH_SIZE` at a time.
+        '''
+        for chunk in _chunks(keys, self.BATCH_SIZE):
+            list(self._map_shards(Database.delete_many,
+                self._partition((k, k) for k in chunk)))
+
+    def _partition(self, pairs):
+        '''Group items by shard.
+
+        :param pairs: An iterable of ``(key, item)``.
+        :returns: A ``dict`` of shard index to list of items.
+        '''
+        partitions = collections.defaultdict(list)
+
+        for k, item in pairs:
+            partitions[self._shard_index(k)].append(item)
+
+        return partitions
+
+    def _map_shards(self, function, partitions, *args):
+        '''Call ``function(shard, items, *args)`` for each shard in
+        parallel.'''
+        futures = [self._executor.submit(function, self._shards[index], items,
+            *args) for index, items in partitions.items()]
+
+        for future in futures:
+            yield future.result()
+
+    def add_index(self, *args, **kwargs):
+        '''Declare a secondary index on every shard.
+
+        See :meth:`Database.add_index`.
+        '''
+        for shard in self._shards:
+            shard.add_index(*args, **kwargs)
+
+    def find(self, name, value):
+        '''See :meth:`Database.find`.'''
+        return heapq.merge(*[shard.find(name, value)
+            for shard in self._shards])
+
+    def sweep(self, **kwargs):
+        '''Sweep each shard in parallel.
+
+        See :meth:`Database.sweep`.
+
+        :returns: A list of :class:`SweepResult`.
+        '''
+        futures = [self._executor.submit(shard.sweep, **kwargs)
+            for shard in self._shards]
+
+        return [future.result() for future in futures]
+
+    def close(self):
+        '''Close the shards.'''
+        self._executor.shutdown()
+
+        for shard in self._shards:
+            shard.close()
+
+
+class Purger(threading.Thread):
+    def __init__(self, database, interval=60.0, autostart=True,
+    **sweep_kwargs):
+        '''Periodically sweep a database in the background.
+
+        :param database: A :class:`Database`.
+        :param interval: Seconds between sweeps.
+        :param autostart: If `True`, the thread is started automatically.
+
+        Other arguments are passed to :meth:`Database.sweep`. The result of
+        the last sweep is available as :attr:`result`.
+        '''
+        threading.Thread.__init__(self)
+        self.name = 'Purger'
+        self.daemon = True
+        self.result = None
+        self._database = database
+        self._interval = interval
+        self._sweep_kwargs = sweep_kwargs
+        self._stop_event = threading.Event()
+
+        if autostart:
+            self.start()
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            try:
+                self.result = self._database.sweep(**self._sweep_kwargs)
+            except Exception:
+                _logger.exception('Sweep failed')
+
+    def stop(self):
+        '''Stop sweeping.'''
+        self._stop_event.set()
+
+
+def reshard(source, destination, batch_size=10000):
+    '''Copy all items from one database to another.
+
+    Use it to move a :class:`Database` into a :class:`ShardedDatabase` or
+    to change the number of shards::
+
+        new_db = ShardedDatabase(new_paths)
+        reshard(old_db, new_db)
+
+    :param source: A :class:`Database` or :class:`ShardedDatabase`.
+    :param destination: A :class:`Database` or :class:`ShardedDatabase`.
+    :param batch_size: The number of items written per transaction.
+
+    Expiry times are copied. Expired items are not.
+    '''
+    for chunk in _chunks(source._iteritems_expiry(), batch_size):
+        destination._set_many_expiry(chunk)
+
+
+class _KeysView(collections.abc.KeysView):
+    def __iter__(self):
+        return self._mapping.iterkeys()
+
+
+class _ValuesView(collections.abc.ValuesView):
+    def __iter__(self):
+        return self._mapping.itervalues()
+
+
+class _ItemsView(collections.abc.ItemsView):
+    def __iter__(self):
+        return self._mapping.iteritems()
+
+
+def _index_entries(function, items):
+    '''Yield ``(index value, key)`` rows.'''
+    for k, v in items:
+        index_value = function(v)
+
+        if index_value is None:
+            continue
+
+        if isinstance(index_value, (list, tuple, set, frozenset)):
+            for item in index_value:
+                yield item, k
+        else:
+            yield index_value, k
+
+
+def _quote(text):
+    '''Return an SQL string literal.'''
+    return "'{}'".format(text.replace("'", "''"))
+
+
+def _path_index_name(path):
+    return 't_path_' + hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+
+
+def _parse_path(path):
+    '''Return the list of members and indexes of a JSON path.'''
+    if not path.startswith('$'):
+        raise ValueError('JSON path must start with $')
+
+    tokens = []
+    position = 1
+
+    while position < len(path):
+        match = _PATH_TOKEN_PATTERN.match(path, position)
+
+        if not match:
+            raise ValueError('Unsupported JSON path {}'.format(path))
+
+        name, quoted_name, index = match.groups()
+
+        if index is not None:
+            tokens.append(int(index))
+        elif quoted_name is not None:
+            tokens.append(json.loads('"{}"'.format(quoted_name)))
+        else:
+            tokens.append(name)
+
+        position = match.end()
+
+    return tokens
+
+
+def _get_path(value, path, default=None):
+    return _walk(value, _parse_path(path), default)
+
+
+def _walk(value, tokens, default):
+    for token in tokens:
+        try:
+            if isinstance(token, int) != isinstance(value, list):
+                return default
+
+            value = value[token]
+        except (IndexError, KeyError, TypeError):
+            return default
+
+    return value
+
+
+def _set_paths(value, paths):
+    for path, new_value in paths:
+        tokens = _parse_path(path)
+
+        if not tokens:
+            value = new_value
+            continue
+
+        parent = _walk(value, tokens[:-1], None)
+        token = tokens[-1]
+
+        if isinstance(parent, dict) and not isinstance(token, int):
+            parent[token] = new_value
+        elif isinstance(parent, list) and isinstance(token, int):
+            if token < len(parent):
+                parent[token] = new_value
+            elif token == len(parent):
+                parent.append(new_value)
+
+    return value
+
+
+def _merge_patch(value, patch):
+    if not isinstance(patch, dict):
+        return patch
+
+    if not isinstance(value, dict):
+        value = {}
+
+    for key, patch_value in patch.items():
+        if patch_value is None:
+            value.pop(key, None)
+        else:
+            value[key] = _merge_patch(value.get(key), patch_value)
+
+    return value
+
+
+def _is_live(expires):
+    return expires is None or expires > time.time()
+
+
+def _prefix_successor(prefix):
+    '''Return the smallest string greater than all strings with the prefix.
+
+    Returns ``None`` if there is no such string.
+    '''
+    while prefix:
+        code_point = ord(prefix[-1])
+
+        if code_point == 0xd7ff:
+            return prefix[:-1] + chr(0xe000)
+        elif code_point < 0x10ffff:
+            return prefix[:-1] + chr(code_point + 1)
+
+        prefix = prefix[:-1]
+
+
+def _chunks(iterable, size):
+    '''Yield lists of at most `size` items from an iterable.'''
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+
+        if not chunk:
+            break
+
+        yield chunk
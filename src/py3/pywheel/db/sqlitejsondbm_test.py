@@ -1,9 +1,13 @@
 # This file is part of PyWheel.
 # Copyright © 2011-2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
+from pywheel.db.codec import Codec, PickleCodec
+import json
 import os
 import pywheel.db.sqlitejsondbm
+import sqlite3
 import tempfile
+import time
 import unittest
 
 __docformat__ = 'restructuredtext en'
@@ -29,6 +33,311 @@ class TestDB(unittest.TestCase):
 
         self.assertEqual(0, len(db.keys()))
 
+    def test_many(self):
+        tempdir = tempfile.TemporaryDirectory()
+        db = pywheel.db.sqlitejsondbm.Database(os.path.join(tempdir.name,
+            'kittens.db'))
+        db.CHUNK_SIZE = 7
+
+        db.set_many(('key{}'.format(i), i) for i in range(20))
+        db.set_many({'key0': 'zero'})
+
+        self.assertEqual(20, len(db))
+
+        values = db.get_many(['key0', 'key19', 'non_existant'])
+
+        self.assertEqual({'key0': 'zero', 'key19': 19}, values)
+
+        db.delete_many('key{}'.format(i) for i in range(10))
+
+        self.assertEqual(10, len(db))
+        self.assertEqual(10, len(db.get_many(db.keys())))
+
+    def test_transaction(self):
+        tempdir = tempfile.TemporaryDirectory()
+        db = pywheel.db.sqlitejsondbm.Database(os.path.join(tempdir.name,
+            'kittens.db'))
+
+        with db.transaction():
+            db['a'] = {'x': 1}
+            db.update('a', {'y': 2})
+
+            try:
+                with db.transaction():
+                    db['b'] = 2
+                    raise ValueError()
+            except ValueError:
+                pass
+
+            self.assertNotIn('b', db)
+
+        self.assertEqual({'x': 1, 'y': 2}, db['a'])
+
+        def f():
+            with db.transaction():
+                del db['a']
+                raise ValueError()
+
+        self.assertRaises(ValueError, f)
+        self.assertIn('a', db)
+
+    def test_cache(self):
+        tempdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tempdir.name, 'kittens.db')
+        db = pywheel.db.sqlitejsondbm.Database(path, cache_items=10,
+            watch_data_version=True)
+        other_db = pywheel.db.sqlitejsondbm.Database(path)
+
+        db['a'] = 1
+
+        self.assertEqual(1, db['a'])
+        self.assertEqual(1, db['a'])
+        self.assertEqual(1, db.cache.hits)
+
+        other_db['a'] = 2
+
+        self.assertEqual(2, db['a'])
+
+        value = {'x': 1}
+        db['c'] = value
+        value['x'] = 99
+
+        self.assertEqual({'x': 1}, db['c'])
+
+        del db['a']
+
+        self.assertNotIn('a', db)
+
+        with db.transaction():
+            db['b'] = 1
+
+        self.assertEqual({'b': 1}, db.get_many(['a', 'b']))
+        self.assertEqual({'b': 1}, db.get_many(['a', 'b']))
+
+    def test_codec(self):
+        tempdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tempdir.name, 'kittens.db')
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE TABLE t(k TEXT PRIMARY KEY, v TEXT)')
+        connection.execute('INSERT INTO t VALUES (?, ?)', ['old', '[1, 2]'])
+        connection.commit()
+        connection.close()
+
+        db = pywheel.db.sqlitejsondbm.Database(path, codec=PickleCodec(),
+            compress_threshold=100)
+        db['set'] = set([1, 2])
+        db['big'] = 'kitteh' * 100
+
+        self.assertEqual([1, 2], db['old'])
+        self.assertEqual(set([1, 2]), db['set'])
+        self.assertEqual('kitteh' * 100, db['big'])
+
+    def test_custom_codec(self):
+        class PrefixCodec(Codec):
+            tag = 7
+
+            def encode(self, value):
+                return 'kitteh:' + json.dumps(value)
+
+            def decode(self, data):
+                if isinstance(data, bytes):
+                    data = data.decode()
+
+                return json.loads(data[len('kitteh:'):])
+
+        class BadCodec(PrefixCodec):
+            tag = 0
+
+        tempdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tempdir.name, 'kittens.db')
+        db = pywheel.db.sqlitejsondbm.Database(path, codec=PrefixCodec(),
+            compress_threshold=100)
+        db['a'] = [1, 2]
+        db['b'] = 'kitteh' * 100
+
+        self.assertEqual([1, 2], db['a'])
+        self.assertEqual('kitteh' * 100, db['b'])
+        self.assertRaises(ValueError, pywheel.db.sqlitejsondbm.Database,
+            path, codec=BadCodec())
+
+    def test_iterate(self):
+        tempdir = tempfile.TemporaryDirectory()
+        db = pywheel.db.sqlitejsondbm.Database(os.path.join(tempdir.name,
+            'kittens.db'))
+        db.FETCH_SIZE = 3
+
+        db.set_many(('key{:02d}'.format(i), i) for i in range(20))
+        db['key00'] = 'zero'
+        db['other'] = -1
+        del db['key19']
+
+        self.assertEqual(20, len(db))
+        self.assertEqual(20, len(list(db.keys())))
+        self.assertEqual(['key00', 'key01'], list(db.keys())[:2])
+        self.assertEqual('zero', list(db.values())[0])
+        self.assertEqual(('other', -1), list(db.items())[-1])
+        self.assertEqual(9, len(list(db.iterkeys(prefix='key1'))))
+        self.assertEqual(['key05', 'key06'],
+            list(db.iterkeys(start='key05', stop='key07')))
+        self.assertEqual([('key10', 10)],
+            list(db.iteritems(prefix='key1', stop='key11')))
+
+    def test_ttl(self):
+        tempdir = tempfile.TemporaryDirectory()
+        db = pywheel.db.sqlitejsondbm.Database(os.path.join(tempdir.name,
+            'kittens.db'), cache_items=10)
+
+        db.set_many(('key{}'.format(i), 'x' * 1000) for i in range(10))
+        db.set('a', 1, ttl=0.05)
+        db.set_many({'b': 2, 'c': 3}, ttl=0.05)
+        db['d'] = 4
+
+        self.assertEqual(1, db['a'])
+        self.assertEqual(14, len(db))
+
+        time.sleep(0.06)
+
+        self.assertNotIn('a', db)
+        self.assertEqual({'d': 4}, db.get_many(['a', 'b', 'c', 'd']))
+        self.assertEqual(11, len(db))
+        self.assertEqual(11, len(list(db.items())))
+
+        result = db.sweep()
+
+        self.assertEqual(3, result.deleted)
+        self.assertEqual(11, len(db))
+
+        db.delete_many('key{}'.format(i) for i in range(10))
+        result = db.sweep()
+
+        self.assertLess(result.size_after, result.size_before)
+
+    def test_purger(self):
+        tempdir = tempfile.TemporaryDirectory()
+        db = pywheel.db.sqlitejsondbm.Database(os.path.join(tempdir.name,
+            'kittens.db'), default_ttl=0)
+        db['a'] = 1
+
+        purger = pywheel.db.sqlitejsondbm.Purger(db, interval=0.01)
+        time.sleep(0.1)
+        purger.stop()
+        purger.join(timeout=0.1)
+
+        self.assertFalse(purger.is_alive())
+        self.assertTrue(purger.result)
+        self.assertEqual(0, db.purge_expired())
+
+    def test_json_path(self):
+        tempdir = tempfile.TemporaryDirectory()
+        db = pywheel.db.sqlitejsondbm.Database(os.path.join(tempdir.name,
+            'kittens.db'), cache_items=10)
+        db['a'] = {'x': {'y': [1, {'z': True}]}, 'n': 'kitteh'}
+        db.set('b', {'x': {'y': [2]}, 'n': 'kitteh'}, ttl=60)
+        db['c'] = {'n': 'dog'}
+        db['a']
+
+        self.assertEqual(True, db.get_path('a', '$.x.y[1].z'))
+        self.assertEqual([1, {'z': True}], db.get_path('a', '$.x.y'))
+        self.assertEqual(None, db.get_path('a', '$.missing'))
+        self.assertRaises(IndexError, db.get_path, 'missing', '$.x')
+
+        db.update_paths('a', {'$.x.y[0]': 5, '$.new': {'q': 1}})
+        db.patch('b', {'x': {'w': 3}, 'n': None})
+
+        self.assertEqual({'x': {'y': [5, {'z': True}]}, 'n': 'kitteh',
+            'new': {'q': 1}}, db['a'])
+        self.assertEqual({'x': {'y': [2], 'w': 3}}, db['b'])
+
+        db.create_path_index('$.n')
+
+        self.assertEqual(['a', 'c'], sorted(db.find_path('$.n', 'kitteh')) +
+            list(db.find_path('$.n', 'dog')))
+
+    def test_json_path_other_codec(self):
+        tempdir = tempfile.TemporaryDirectory()
+        db = pywheel.db.sqlitejsondbm.Database(os.path.join(tempdir.name,
+            'kittens.db'), codec=PickleCodec())
+        db['a'] = {'x': {'y': [1, 2]}}
+
+        self.assertEqual(2, db.get_path('a', '$.x.y[1]'))
+
+        db.update_paths('a', {'$.x.y[1]': 3})
+        db.patch('a', {'z': 4})
+
+        self.assertEqual({'x': {'y': [1, 3]}, 'z': 4}, db['a'])
+
+    def test_index(self):
+        tempdir = tempfile.TemporaryDirectory()
+        db = pywheel.db.sqlitejsondbm.Database(os.path.join(tempdir.name,
+            'kittens.db'))
+        db['a'] = {'user_id': 1, 'tags': ['cat', 'cute']}
+        db.add_index('user', path='$.user_id')
+        db.add_index('tag', function=lambda value: value.get('tags'))
+        db.set_many({
+            'b': {'user_id': 2, 'tags': ['cat']},
+            'c': {'user_id': 1},
+        })
+        db['d'] = {'user_id': 3}
+
+        self.assertEqual(['a', 'c'], list(db.find('user', 1)))
+        self.assertEqual(['a', 'b'], list(db.find('tag', 'cat')))
+        self.assertEqual(['b', 'd'], list(db.find_range('user', start=2)))
+
+        db.update_paths('c', {'$.user_id': 2})
+        db.patch('a', {'tags': None})
+        del db['b']
+
+        self.assertEqual(['c'], list(db.find('user', 2)))
+        self.assertEqual([], list(db.find('tag', 'cat')))
+
+        db.set('e', {'user_id': 3}, ttl=-1)
+
+        self.assertEqual(['d'], list(db.find('user', 3)))
+        self.assertRaises(ValueError, db.add_index, 'bad name', '$.a')
+
+
+class TestShardedDatabase(unittest.TestCase):
+    def test_simple(self):
+        tempdir = tempfile.TemporaryDirectory()
+        db = pywheel.db.sqlitejsondbm.ShardedDatabase([
+            os.path.join(tempdir.name, 'kittens{}.db'.format(i))
+            for i in range(3)])
+        db.BATCH_SIZE = 7
+
+        db.set_many(('key{:02d}'.format(i), i) for i in range(20))
+        db['key00'] = 'zero'
+        db.set('expiring', 1, ttl=0.3)
+        db.set('expired', 1, ttl=-1)
+        del db['key19']
+
+        self.assertEqual(20, len(db))
+        self.assertTrue(all(len(shard) for shard in db.shards))
+        self.assertEqual(sorted(db.keys()), list(db.keys()))
+        self.assertEqual('zero', db['key00'])
+        self.assertEqual({'key00': 'zero', 'key01': 1},
+            db.get_many(['key00', 'key01', 'key19']))
+
+        db.delete_many(['key00', 'key01'])
+
+        self.assertEqual(18, len(db))
+
+        resharded_db = pywheel.db.sqlitejsondbm.ShardedDatabase([
+            os.path.join(tempdir.name, 'resharded{}.db'.format(i))
+            for i in range(2)])
+
+        pywheel.db.sqlitejsondbm.reshard(db, resharded_db, batch_size=5)
+
+        self.assertEqual(list(db.items()), list(resharded_db.items()))
+        self.assertNotIn('expired', resharded_db)
+        self.assertIn('expiring', resharded_db)
+
+        time.sleep(0.3)
+
+        self.assertNotIn('expiring', resharded_db)
+
+        db.close()
+        resharded_db.close()
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
@@ -0,0 +1,119 @@
+'''Session controller using SQLite'''
+# This file is part of PyWheel.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+from pywheel.db.sqlite import Connector
+from pywheel.web.tornado.session import BaseSessionController, LazySession
+import time
+import uuid
+
+
+class SQLiteSessionController(BaseSessionController):
+    CLEAN_CHUNK_SIZE = 500
+    '''Number of sessions deleted per transaction by :meth:`clean`'''
+    CHUNK_SIZE = 500
+    '''Number of IDs per query of :meth:`get_session_dicts`'''
+
+    def __init__(self, path, pool_size=4, lazy=False, **connector_kwargs):
+        '''Session controller using SQLite
+
+        Sessions are stored in the format of :meth:`.LazySession.to_bytes`
+        in a table with an indexed last modified column.
+
+        :param pool_size: The number of pooled connections.
+            See :class:`.Connector`.
+        :param lazy: If `True`, sessions are loaded as :class:`.LazySession`
+            and only unpickled when used.
+        '''
+        self._lazy = lazy
+        self._connector = Connector(path, pool_size=pool_size,
+            **connector_kwargs)
+
+        with self._connector() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS sessions '
+                '(id BLOB PRIMARY KEY, last_mod INTEGER NOT NULL, '
+                'data BLOB NOT NULL)')
+            con.execute('CREATE INDEX IF NOT EXISTS sessions_last_mod '
+                'ON sessions(last_mod)')
+
+    def get_session_dict(self, id_):
+        with self._connector() as con:
+            row = con.execute('SELECT data FROM sessions WHERE id = ?',
+                [id_]).fetchone()
+
+        if row:
+            return self._decode(id_, row[0])
+
+    def get_session_dicts(self, ids):
+        ids = list(ids)
+        session_dicts = {}
+
+        with self._connector() as con:
+            for index in range(0, len(ids), self.CHUNK_SIZE):
+                chunk = ids[index:index + self.CHUNK_SIZE]
+                rows = con.execute('SELECT id, data FROM sessions '
+                    'WHERE id IN ({})'.format(', '.join('?' * len(chunk))),
+                    chunk)
+
+                for id_, data in rows:
+                    session_dicts[id_] = self._load_session(
+                        self._decode(id_, data))
+
+        return session_dicts
+
+    def save_session_dict(self, session_dict):
+        self.save_session_dicts([session_dict])
+
+    def save_session_dicts(self, session_dicts):
+        rows = []
+
+        for session_dict in session_dicts:
+            if not session_dict.id:
+                session_dict.id = uuid.uuid4().bytes
+
+            rows.append((session_dict.id, session_dict.last_modified,
+                LazySession.from_dict(session_dict).to_bytes()))
+
+        with self._connector() as con:
+            con.executemany('INSERT OR REPLACE INTO sessions '
+                '(id, last_mod, data) VALUES (?, ?, ?)', rows)
+
+    def clean(self, max_items=None):
+        expire_time = time.time() - BaseSessionController.EXPIRE_TIME
+        count = 0
+
+        while max_items is None or count < max_items:
+            chunk_size = self.CLEAN_CHUNK_SIZE
+
+            if max_items is not None:
+                chunk_size = min(chunk_size, max_items - count)
+
+            with self._connector() as con:
+                cur = con.execute('DELETE FROM sessions WHERE rowid IN '
+                    '(SELECT rowid FROM sessions WHERE last_mod < ? '
+                    'ORDER BY last_mod LIMIT ?)', [expire_time, chunk_size])
+
+            count += cur.rowcount
+
+            if cur.rowcount < chunk_size:
+                break
+
+        return count
+
+    def close(self):
+        '''Close the pooled connections.'''
+        self._connector.close()
+
+    def _decode(self, id_, data):
+        session = LazySession.from_bytes(id_, data)
+
+        if self._lazy:
+            return session
+        else:
+            return session.to_session_dict()
+
+    def _new_session_dict(self):
+        if self._lazy:
+            return LazySession()
+        else:
+            return BaseSessionController._new_session_dict(self)
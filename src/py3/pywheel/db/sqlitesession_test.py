@@ -0,0 +1,82 @@
+# This file is part of PyWheel.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+from pywheel.db.sqlitesession import SQLiteSessionController
+from pywheel.web.tornado.session import LazySession, Session
+import os.path
+import tempfile
+import time
+import unittest
+
+
+class TestSQLiteSessionController(unittest.TestCase):
+    def test_save_and_get(self):
+        '''It should save and return the data'''
+
+        tempdir = tempfile.TemporaryDirectory()
+        s = SQLiteSessionController(os.path.join(tempdir.name, 'sessions.db'))
+        session_dict = Session()
+        session_dict['hello'] = 'kitten'
+        session_dict.last_modified = int(time.time())
+
+        s.save_session_dict(session_dict)
+
+        test_dict = s.get_session_dict(session_dict.id)
+
+        self.assertTrue(test_dict)
+        self.assertEqual('kitten', test_dict['hello'])
+
+    def test_bulk(self):
+        '''It should save and get many sessions'''
+
+        tempdir = tempfile.TemporaryDirectory()
+        s = SQLiteSessionController(os.path.join(tempdir.name, 'sessions.db'))
+        s.CHUNK_SIZE = 3
+        session_dicts = [Session(number=i) for i in range(10)]
+
+        s.save_session_dicts(session_dicts)
+
+        ids = [session_dict.id for session_dict in session_dicts]
+        test_dicts = s.get_session_dicts(ids + [b'missing'])
+
+        self.assertEqual(10, len(test_dicts))
+        self.assertEqual(9, test_dicts[ids[9]]['number'])
+
+        test_dicts[ids[9]]['number'] = 99
+        s.save_session_dicts(test_dicts.values())
+
+        self.assertEqual(99, s.get_session_dict(ids[9])['number'])
+
+    def test_lazy(self):
+        '''It should return lazy sessions'''
+
+        tempdir = tempfile.TemporaryDirectory()
+        s = SQLiteSessionController(os.path.join(tempdir.name, 'sessions.db'),
+            lazy=True)
+        session_dict = Session(hello='kitten')
+        s.save_session_dict(session_dict)
+
+        test_dict = s.get_session_dict(session_dict.id)
+
+        self.assertIsInstance(test_dict, LazySession)
+        self.assertFalse(test_dict.loaded)
+        self.assertEqual('kitten', test_dict['hello'])
+
+    def test_clean(self):
+        '''It should delete expired sessions in chunks'''
+
+        tempdir = tempfile.TemporaryDirectory()
+        s = SQLiteSessionController(os.path.join(tempdir.name, 'sessions.db'))
+        s.CLEAN_CHUNK_SIZE = 2
+        session_dicts = [Session() for dummy in range(5)]
+
+        for session_dict in session_dicts[:4]:
+            s.save_session_dict(session_dict)
+
+        session_dicts[4].last_modified = int(time.time())
+        s.save_session_dict(session_dicts[4])
+
+        self.assertEqual(1, s.clean(max_items=1))
+        self.assertEqual(3, s.clean())
+        self.assertEqual(None, s.get_session_dict(session_dicts[0].id))
+        self.assertTrue(s.get_session_dict(session_dicts[4].id))
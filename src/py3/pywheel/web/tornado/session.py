@@ -2,23 +2,41 @@
 # This file is part of PyWheel.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
+from pywheel.cache import LRUCache
 import abc
+import asyncio
+import collections
+import collections.abc
 import contextlib
+import hashlib
+import heapq
+import json
+import logging
+import pickle
+import struct
+import threading
 import time
 import uuid
+import zlib
+
+_logger = logging.getLogger(__name__)
 
 
 class Session(dict):
     '''A ``dict`` with properties'''
 
-    __slots__ = ()
+    __slots__ = ('_fingerprint',)
     ID = '_id'
     LAST_MODIFIED = '_last_mod'
     COOKIE_TIMESTAMP = '_cookie_time'
     PERSISTENT = '_persist'
-    UNCHECKED_KEYS = frozenset((LAST_MODIFIED, COOKIE_TIMESTAMP, PERSISTENT))
+    VERSION = '_ver'
+    UNCHECKED_KEYS = frozenset((LAST_MODIFIED, COOKIE_TIMESTAMP, PERSISTENT,
+        VERSION))
+    UNHASHED_KEYS = frozenset((LAST_MODIFIED, COOKIE_TIMESTAMP, VERSION))
 
     def __init__(self, *args, **kwargs):
+        self._fingerprint = None
         self.id = None
         self.last_modified = 0
         self.cookie_timestamp = 0
@@ -70,24 +88,260 @@ class Session(dict):
 
         self[Session.PERSISTENT] = b
 
+    @property
+    def version(self):
+        '''The number of saves counted by :class:`CachingSessionController`
+        (int)'''
+        return self.get(Session.VERSION, 0)
+
+    @version.setter
+    def version(self, version):
+        self[Session.VERSION] = version
+
     @property
     def dirty(self):
-        if Session.ID in self:
-            return True
+        '''Whether the contents changed since :meth:`mark_clean`
 
-        for k in self.keys():
-            if k not in Session.UNCHECKED_KEYS:
-                return True
+        A session that was never marked clean is dirty if it contains
+        anything other than its properties.
+        '''
+        if self._fingerprint is None:
+            for k in self.keys():
+                if k != Session.ID and k not in Session.UNCHECKED_KEYS:
+                    return True
 
-        return False
+            return False
 
+        return self._fingerprint != self.fingerprint()
 
-class BaseSessionController(object, metaclass=abc.ABCMeta):
-    '''Manages sessions or HTTP states'''
+    def mark_clean(self):
+        '''Remember the current contents so later changes are detected.'''
+        self._fingerprint = self.fingerprint()
+
+    def fingerprint(self):
+        '''Return a digest of the contents excluding the timestamps.
+
+        Values that cannot be pickled give a digest that never matches, so
+        the session is always saved.
+        '''
+        content = [(k, v) for k, v in self.items()
+            if k not in Session.UNHASHED_KEYS]
+
+        try:
+            data = pickle.dumps(content, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return object()
+
+        return hashlib.sha1(data).digest()
+
+
+class LazySession(collections.abc.MutableMapping):
+    '''A session that is decoded on first use
+
+    The properties of :class:`Session` are plain attributes instead of
+    keys. The contents are kept as the stored bytes until a key is
+    accessed, so requests that do not use the session do not unpickle it,
+    and an unused session is saved again without pickling it.
+
+    Controllers that store bytes return it when created with
+    ``lazy=True``.
+    '''
+
+    __slots__ = ('id', 'last_modified', 'cookie_timestamp', '_persistent',
+        'version', '_data', '_raw', '_fingerprint')
+    HEADER = struct.Struct('<qq?q')
+    '''Last modified time, cookie timestamp, persistent flag and version'''
+
+    def __init__(self, *args, **kwargs):
+        self.id = None
+        self.last_modified = 0
+        self.cookie_timestamp = 0
+        self._persistent = False
+        self.version = 0
+        self._data = dict(*args, **kwargs)
+        self._raw = None
+        self._fingerprint = None
+
+    @classmethod
+    def from_bytes(cls, id_, data):
+        '''Return a session from the value of :meth:`to_bytes`.'''
+        session = cls()
+        session.id = id_
+        session.last_modified, session.cookie_timestamp, \
+            session._persistent, session.version = \
+            cls.HEADER.unpack_from(data)
+        session._data = None
+        session._raw = data[cls.HEADER.size:]
+
+        return session
+
+    @classmethod
+    def from_dict(cls, session_dict):
+        '''Return a session from a :class:`Session` or a stored copy.'''
+        if isinstance(session_dict, LazySession):
+            return session_dict
+
+        session = cls((k, v) for k, v in session_dict.items()
+            if k != Session.ID and k not in Session.UNCHECKED_KEYS)
+        session.id = session_dict.get(Session.ID)
+        session.last_modified = session_dict.get(Session.LAST_MODIFIED, 0)
+        session.cookie_timestamp = session_dict.get(
+            Session.COOKIE_TIMESTAMP, 0)
+        session._persistent = session_dict.get(Session.PERSISTENT, False)
+        session.version = session_dict.get(Session.VERSION, 0)
+
+        return session
+
+    def to_bytes(self):
+        '''Return the properties except the ID and the contents.'''
+        return self.HEADER.pack(int(self.last_modified),
+            int(self.cookie_timestamp), self._persistent, self.version) + \
+            self._encoded()
+
+    def to_session_dict(self):
+        '''Return the contents and properties as a ``dict`` of
+        :class:`Session` keys.'''
+        session_dict = dict(self._load())
+        session_dict[Session.ID] = self.id
+        session_dict[Session.LAST_MODIFIED] = self.last_modified
+        session_dict[Session.COOKIE_TIMESTAMP] = self.cookie_timestamp
+        session_dict[Session.PERSISTENT] = self._persistent
+
+        if self.version:
+            session_dict[Session.VERSION] = self.version
+
+        return session_dict
+
+    @property
+    def persistent(self):
+        '''See :attr:`Session.persistent`.'''
+        return self._persistent
+
+    @persistent.setter
+    def persistent(self, b):
+        if b != self._persistent:
+            self.cookie_timestamp = 0
+
+        self._persistent = b
+
+    @property
+    def loaded(self):
+        '''Whether the contents were decoded.'''
+        return self._data is not None
+
+    @property
+    def dirty(self):
+        '''See :attr:`Session.dirty`.'''
+        if self._fingerprint is None:
+            return bool(self._data)
+
+        return self._fingerprint != (self._persistent, self._encoded())
+
+    def mark_clean(self):
+        '''See :meth:`Session.mark_clean`.'''
+        self._fingerprint = (self._persistent, self._encoded())
+
+    def _encoded(self):
+        if self._data is None:
+            return self._raw
+
+        return pickle.dumps(self._data, pickle.HIGHEST_PROTOCOL)
+
+    def _load(self):
+        if self._data is None:
+            self._data = pickle.loads(self._raw)
+
+        return self._data
+
+    def __getitem__(self, k):
+        return self._load()[k]
+
+    def __setitem__(self, k, v):
+        self._load()[k] = v
+
+    def __delitem__(self, k):
+        del self._load()[k]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        return '<LazySession {!r}>'.format(self.id)
+
+
+class _SessionControllerBase(object):
+    '''Cookie and timestamp handling shared by the session controllers'''
 
     COOKIE_NAME = 'pywheelsid'
     COOKIE_SET_INTERVAL = 1296000  # 15 days
     EXPIRE_TIME = 2678400  # 31 days
+    TOUCH_INTERVAL = 3600
+    '''Seconds before an unchanged session is saved to renew its expiry'''
+
+    def _prepare_save(self, session):
+        '''Decide whether the session is saved and update its timestamps.
+
+        Unchanged sessions are only saved when the cookie needs to be
+        sent again or when :attr:`TOUCH_INTERVAL` has passed.
+
+        :returns: A tuple of whether to save and whether to send the cookie.
+        '''
+        time_now = time.time()
+        need_set_cookie = time_now - session.cookie_timestamp > \
+            BaseSessionController.COOKIE_SET_INTERVAL
+
+        if session.id is None:
+            need_save = session.dirty
+        else:
+            need_save = session.dirty or need_set_cookie \
+                or time_now - session.last_modified > self.TOUCH_INTERVAL
+
+        if need_save:
+            if need_set_cookie:
+                session.cookie_timestamp = int(time_now)
+
+            session.last_modified = int(time_now)
+
+        return need_save, need_save and need_set_cookie
+
+    def _get_session_id(self, request_handler):
+        return request_handler.get_secure_cookie(
+            BaseSessionController.COOKIE_NAME)
+
+    def _load_session(self, stored_session_dict):
+        '''Return a session populated from the stored session dict.
+
+        A stored :class:`LazySession` is used as it is.
+        '''
+        if isinstance(stored_session_dict, LazySession):
+            stored_session_dict.mark_clean()
+            return stored_session_dict
+
+        session = self._new_session_dict()
+
+        if stored_session_dict is not None:
+            session.update(stored_session_dict)
+            session.mark_clean()
+
+        return session
+
+    def _new_session_dict(self):
+        '''Return a new session.'''
+        return Session()
+
+    def _send_cookie(self, request_handler, session):
+        '''Send a cookie to the browser.'''
+        expires_days = 30 if session.persistent else None
+
+        request_handler.set_secure_cookie(BaseSessionController.COOKIE_NAME,
+            session.id, expires_days=expires_days)
+
+
+class BaseSessionController(_SessionControllerBase, metaclass=abc.ABCMeta):
+    '''Manages sessions or HTTP states'''
 
     @abc.abstractmethod
     def get_session_dict(self, id_):
@@ -107,10 +361,42 @@ class BaseSessionController(object, metaclass=abc.ABCMeta):
         pass
 
     @abc.abstractmethod
-    def clean(self):
-        '''Delete expired sessions.'''
+    def clean(self, max_items=None):
+        '''Delete expired sessions.
+
+        :param max_items: If given, delete at most this many sessions so
+            a call does not take long. The oldest sessions go first.
+        :returns: The number of deleted sessions or ``None`` if unknown.
+        '''
         pass
 
+    def get_session_dicts(self, ids):
+        '''Return a ``dict`` of sessions by ID.
+
+        The values are :class:`Session` or :class:`LazySession` objects
+        that can be changed and passed to :meth:`save_session_dicts`.
+        IDs of sessions that do not exist are left out. Controllers
+        override it to fetch the sessions in fewer round trips.
+        '''
+        session_dicts = {}
+
+        for id_ in ids:
+            session_dict = self.get_session_dict(id_)
+
+            if session_dict is not None:
+                session_dicts[id_] = self._load_session(session_dict)
+
+        return session_dicts
+
+    def save_session_dicts(self, session_dicts):
+        '''Save several session dicts.
+
+        See :meth:`save_session_dict`. Controllers override it to save the
+        sessions in fewer round trips.
+        '''
+        for session_dict in session_dicts:
+            self.save_session_dict(session_dict)
+
     @contextlib.contextmanager
     def __call__(self, request_handler, save=True):
         '''Return a session to be used using the ``with`` statement.
@@ -124,64 +410,723 @@ class BaseSessionController(object, metaclass=abc.ABCMeta):
 
         yield session
 
-        need_set_cookie = time.time() - session.cookie_timestamp > \
-            BaseSessionController.COOKIE_SET_INTERVAL
+        if save:
+            self._finish_session(request_handler, session)
 
-        if save and session.dirty:
-            if need_set_cookie:
-                session.cookie_timestamp = int(time.time())
+    def _finish_session(self, request_handler, session):
+        '''Save the session and send the cookie if needed.'''
+        need_save, need_set_cookie = self._prepare_save(session)
 
-            session.last_modified = int(time.time())
+        if need_save:
             self.save_session_dict(session)
+            session.mark_clean()
 
-            if need_set_cookie:
-                self._send_cookie(request_handler, session)
+        if need_set_cookie:
+            self._send_cookie(request_handler, session)
 
     def _get_session(self, request_handler):
         '''Get a stored session or a new session.'''
-        session_id = request_handler.get_secure_cookie(
-            BaseSessionController.COOKIE_NAME)
-        session = self._new_session_dict()
+        session_id = self._get_session_id(request_handler)
+        stored_session_dict = None
 
         if session_id:
             stored_session_dict = self.get_session_dict(session_id)
 
-            if stored_session_dict is not None:
-                session.update(stored_session_dict)
+        return self._load_session(stored_session_dict)
 
-        return session
 
-    def _new_session_dict(self):
-        '''Return a new session.'''
-        return Session()
+class AsyncBaseSessionController(_SessionControllerBase,
+metaclass=abc.ABCMeta):
+    '''Manages sessions without blocking the event loop
 
-    def _send_cookie(self, request_handler, session):
-        '''Send a cookie to the browser.'''
-        expires_days = 30 if session.persistent else None
+    Example::
 
-        request_handler.set_secure_cookie(BaseSessionController.COOKIE_NAME,
-            session.id, expires_days=expires_days)
+        async with self.application.session(self) as session:
+            session['text'] = 'kittens'
+
+    '''
+
+    @abc.abstractmethod
+    async def get_session_dict(self, id_):
+        '''Return the session dict given an ID.'''
+        pass
+
+    @abc.abstractmethod
+    async def save_session_dict(self, session_dict):
+        '''Save the session dict.
+
+        See :meth:`BaseSessionController.save_session_dict`.
+        '''
+        pass
+
+    @abc.abstractmethod
+    async def clean(self, max_items=None):
+        '''Delete expired sessions.
+
+        See :meth:`BaseSessionController.clean`.
+        '''
+        pass
+
+    async def get_session_dicts(self, ids):
+        '''See :meth:`BaseSessionController.get_session_dicts`.'''
+        session_dicts = {}
+
+        for id_ in ids:
+            session_dict = await self.get_session_dict(id_)
+
+            if session_dict is not None:
+                session_dicts[id_] = self._load_session(session_dict)
+
+        return session_dicts
+
+    async def save_session_dicts(self, session_dicts):
+        '''See :meth:`BaseSessionController.save_session_dicts`.'''
+        for session_dict in session_dicts:
+            await self.save_session_dict(session_dict)
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, request_handler, save=True):
+        '''Return a session to be used using the ``async with`` statement.
+
+        :type request_handler: :class:`tornado.web.RequestHandler`
+        :rtype: :class:`Session`
+        '''
+        session = await self._get_session(request_handler)
+
+        assert session is not None
+
+        yield session
+
+        if save:
+            await self._finish_session(request_handler, session)
+
+    async def _finish_session(self, request_handler, session):
+        '''Save the session and send the cookie if needed.'''
+        need_save, need_set_cookie = self._prepare_save(session)
+
+        if need_save:
+            await self.save_session_dict(session)
+            session.mark_clean()
+
+        if need_set_cookie:
+            self._send_cookie(request_handler, session)
+
+    async def _get_session(self, request_handler):
+        '''Get a stored session or a new session.'''
+        session_id = self._get_session_id(request_handler)
+        stored_session_dict = None
+
+        if session_id:
+            stored_session_dict = await self.get_session_dict(session_id)
+
+        return self._load_session(stored_session_dict)
 
 
 class MemorySessionController(BaseSessionController):
-    '''Provides a in-memory session controller for testing.'''
-    def __init__(self):
+    '''Provides a in-memory session controller for testing.
+
+    Expiry uses a heap ordered by last modified time. A save pushes a new
+    heap entry and leaves the old one, which is skipped when it is popped.
+    '''
+    def __init__(self, lazy=False):
+        '''
+        :param lazy: If `True`, sessions are stored as bytes and loaded as
+            :class:`LazySession`.
+        '''
+        self._lazy = lazy
         self._table = {}
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def get_session_dict(self, id_):
+        entry = self._table.get(id_)
+
+        if entry is None:
+            return None
+        elif self._lazy:
+            return LazySession.from_bytes(id_, entry[1])
+        else:
+            return entry[1]
+
+    def save_session_dict(self, session_dict):
+        self.save_session_dicts([session_dict])
+
+    def save_session_dicts(self, session_dicts):
+        entries = []
+
+        for session_dict in session_dicts:
+            if not session_dict.id:
+                session_dict.id = uuid.uuid4().bytes
+
+            if self._lazy:
+                data = LazySession.from_dict(session_dict).to_bytes()
+            else:
+                data = dict(session_dict)
+
+            entries.append((session_dict.id, session_dict.last_modified, data))
+
+        with self._lock:
+            for id_, last_modified, data in entries:
+                self._table[id_] = (last_modified, data)
+                heapq.heappush(self._heap, (last_modified, id_))
+
+            if len(self._heap) > 2 * len(self._table) + 64:
+                self._compact()
+
+    def clean(self, max_items=None):
+        expire_time = time.time() - BaseSessionController.EXPIRE_TIME
+        count = 0
+
+        with self._lock:
+            while self._heap and self._heap[0][0] < expire_time \
+            and (max_items is None or count < max_items):
+                last_modified, id_ = heapq.heappop(self._heap)
+                entry = self._table.get(id_)
+
+                if entry is not None and entry[0] == last_modified:
+                    del self._table[id_]
+                    count += 1
+
+        return count
+
+    def _new_session_dict(self):
+        if self._lazy:
+            return LazySession()
+        else:
+            return BaseSessionController._new_session_dict(self)
+
+    def _compact(self):
+        '''Rebuild the heap without the entries of older saves.'''
+        self._heap = [(entry[0], id_) for id_, entry in self._table.items()]
+        heapq.heapify(self._heap)
+
+
+class StripedMemorySessionController(BaseSessionController):
+    '''In-memory sessions for multithreaded servers
+
+    Sessions are split into shards by ID. Each shard has its own lock, so
+    threads using different shards do not wait for each other. Sessions
+    are stored as bytes and their sizes are counted. Each shard evicts its
+    least recently used sessions when it is over its share of the limits.
+    '''
+
+    def __init__(self, shards=16, max_items=None, max_size=None, lazy=False):
+        '''
+        :param shards: The number of shards and locks.
+        :param max_items: The maximum number of sessions. It must be at
+            least `shards`.
+        :param max_size: The maximum number of bytes of stored sessions.
+            A session larger than the share of its shard is not kept.
+        :param lazy: If `True`, sessions are loaded as :class:`LazySession`.
+        '''
+        if max_items is not None and max_items < shards:
+            raise ValueError('max_items must be at least the number of shards')
+
+        self._shards = [_Shard(_share(max_items, shards, index),
+            _share(max_size, shards, index)) for index in range(shards)]
+        self._lazy = lazy
+
+    @property
+    def size(self):
+        '''The number of bytes of stored sessions.'''
+        return sum(shard.size for shard in self._shards)
+
+    @property
+    def evictions(self):
+        '''The number of sessions removed to stay within the limits.'''
+        return sum(shard.evictions for shard in self._shards)
+
+    def __len__(self):
+        return sum(len(shard.table) for shard in self._shards)
 
     def get_session_dict(self, id_):
-        return self._table.get(id_)
+        expire_time = time.time() - BaseSessionController.EXPIRE_TIME
+        shard = self._shards[hash(id_) % len(self._shards)]
+
+        with shard.lock:
+            entry = shard.table.get(id_)
+
+            if entry is None:
+                return None
+
+            if entry[0] < expire_time:
+                shard.remove(id_)
+                return None
+
+            shard.table.move_to_end(id_)
+
+        return self._decode(id_, entry[1])
+
+    def get_session_dicts(self, ids):
+        expire_time = time.time() - BaseSessionController.EXPIRE_TIME
+        session_dicts = {}
+
+        for shard, shard_ids in self._group(ids):
+            with shard.lock:
+                for id_ in shard_ids:
+                    entry = shard.table.get(id_)
+
+                    if entry is None:
+                        continue
+
+                    if entry[0] < expire_time:
+                        shard.remove(id_)
+                        continue
+
+                    shard.table.move_to_end(id_)
+                    session_dicts[id_] = entry[1]
+
+        for id_, data in session_dicts.items():
+            session_dicts[id_] = self._load_session(self._decode(id_, data))
+
+        return session_dicts
 
     def save_session_dict(self, session_dict):
-        id_ = uuid.uuid4().bytes
-        session_dict.id = id_
-        self._table[id_] = session_dict
+        self.save_session_dicts([session_dict])
+
+    def save_session_dicts(self, session_dicts):
+        entries = {}
+
+        for session_dict in session_dicts:
+            if not session_dict.id:
+                session_dict.id = uuid.uuid4().bytes
+
+            entries[session_dict.id] = (session_dict.last_modified,
+                LazySession.from_dict(session_dict).to_bytes())
+
+        for shard, shard_ids in self._group(entries):
+            with shard.lock:
+                for id_ in shard_ids:
+                    shard.remove(id_)
+                    shard.table[id_] = entries[id_]
+                    shard.size += len(id_) + len(entries[id_][1])
+
+                self._evict(shard)
+
+    def clean(self, max_items=None):
+        '''Delete expired sessions.
+
+        Each shard is checked from its least recently used session and
+        stops at the first session that has not expired. Expired sessions
+        behind it are not returned by :meth:`get_session_dict` and are
+        evicted eventually.
+        '''
+        expire_time = time.time() - BaseSessionController.EXPIRE_TIME
+        count = 0
+
+        for shard in self._shards:
+            with shard.lock:
+                while shard.table and (max_items is None or count < max_items):
+                    id_ = next(iter(shard.table))
+
+                    if shard.table[id_][0] >= expire_time:
+                        break
+
+                    shard.remove(id_)
+                    count += 1
+
+        return count
+
+    def _decode(self, id_, data):
+        session = LazySession.from_bytes(id_, data)
+
+        if self._lazy:
+            return session
+        else:
+            return session.to_session_dict()
+
+    def _group(self, ids):
+        '''Return the shards of the IDs with their IDs.'''
+        shard_ids = collections.defaultdict(list)
+
+        for id_ in ids:
+            shard_ids[hash(id_) % len(self._shards)].append(id_)
+
+        return [(self._shards[index], shard_ids[index])
+            for index in sorted(shard_ids)]
+
+    def _evict(self, shard):
+        while shard.table and (
+        shard.max_items is not None and len(shard.table) > shard.max_items
+        or shard.max_size is not None and shard.size > shard.max_size):
+            shard.remove(next(iter(shard.table)))
+            shard.evictions += 1
+
+    def _new_session_dict(self):
+        if self._lazy:
+            return LazySession()
+        else:
+            return BaseSessionController._new_session_dict(self)
+
+
+class _Shard(object):
+    __slots__ = ('lock', 'table', 'size', 'evictions', 'max_items',
+        'max_size')
+
+    def __init__(self, max_items=None, max_size=None):
+        self.lock = threading.Lock()
+        self.table = collections.OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.max_items = max_items
+        self.max_size = max_size
+
+    def remove(self, id_):
+        entry = self.table.pop(id_, None)
+
+        if entry is not None:
+            self.size -= len(id_) + len(entry[1])
+
+
+def _share(limit, count, index):
+    '''Return the part of a limit for one of `count` shards so the parts
+    add up to the limit.'''
+    if limit is not None:
+        return limit // count + (1 if index < limit % count else 0)
+
+
+class SessionCleaner(threading.Thread):
+    def __init__(self, controller, interval=60.0, max_items=None,
+    autostart=True):
+        '''Periodically delete expired sessions in the background.
+
+        :param controller: A :class:`BaseSessionController`.
+        :param interval: Seconds between cleanings.
+        :param max_items: Passed to :meth:`BaseSessionController.clean`.
+            Cleaning continues without waiting while a full batch is
+            deleted.
+        :param autostart: If `True`, the thread is started automatically.
+        '''
+        threading.Thread.__init__(self)
+        self.name = 'SessionCleaner'
+        self.daemon = True
+        self._controller = controller
+        self._interval = interval
+        self._max_items = max_items
+        self._stop_event = threading.Event()
+
+        if autostart:
+            self.start()
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            try:
+                while not self._stop_event.is_set():
+                    count = self._controller.clean(max_items=self._max_items)
+
+                    if self._max_items is None or count is None \
+                    or count < self._max_items:
+                        break
+            except Exception:
+                _logger.exception('Session cleaning failed')
+
+    def stop(self):
+        '''Stop cleaning.'''
+        self._stop_event.set()
+
+
+class CachingSessionController(BaseSessionController):
+    def __init__(self, controller, max_items=10000, ttl=5.0):
+        '''Keep recently used sessions of another controller in memory.
+
+        Saves are written through to `controller` and then cached. Cached
+        sessions are used for at most `ttl` seconds, so changes made by
+        other processes are seen after that.
+
+        Every save increments :attr:`Session.version`. When an expired
+        session is loaded again from `controller` with a different version
+        or contents than the cached one, it is counted in :attr:`stale`.
+        The loaded session always replaces the cached one.
+
+        :param controller: A :class:`BaseSessionController`.
+        :param max_items: The maximum number of cached sessions.
+        :param ttl: The number of seconds a cached session is used.
+        '''
+        self._controller = controller
+        self._ttl = ttl
+        self._cache = LRUCache(max_items=max_items)
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    @property
+    def controller(self):
+        '''The wrapped :class:`BaseSessionController`.'''
+        return self._controller
+
+    @property
+    def cache(self):
+        '''The :class:`.LRUCache` of pickled sessions.'''
+        return self._cache
+
+    @property
+    def hit_rate(self):
+        '''The fraction of lookups answered by the cache.'''
+        total = self.hits + self.misses
+
+        if total:
+            return self.hits / total
+        else:
+            return 0.0
+
+    def get_session_dict(self, id_):
+        entry = self._cache.get(id_)
+
+        if entry is not None and entry[2] > time.time():
+            self.hits += 1
+            return pickle.loads(entry[1])
+
+        self.misses += 1
+        generation = self._cache.generation
+        session_dict = self._controller.get_session_dict(id_)
+
+        if session_dict is None:
+            self._cache.discard(id_)
+            return None
+
+        version = _get_version(session_dict)
+        stored_dict = _to_dict(session_dict)
+
+        if entry is not None and (entry[0] != version
+        or pickle.loads(entry[1]) != stored_dict):
+            self.stale += 1
+
+        self._put(id_, version, stored_dict, generation)
+
+        return session_dict
+
+    def save_session_dict(self, session_dict):
+        session_dict.version += 1
+
+        self._controller.save_session_dict(session_dict)
+        self._cache.discard(session_dict.id)
+        self._put(session_dict.id, session_dict.version, session_dict)
+
+    def clean(self, max_items=None):
+        return self._controller.clean(max_items)
+
+    def _put(self, id_, version, session_dict, generation=None):
+        data = pickle.dumps(_to_dict(session_dict), pickle.HIGHEST_PROTOCOL)
+
+        self._cache.put(id_, (version, data, time.time() + self._ttl),
+            generation=generation)
+
+
+def _get_version(session_dict):
+    '''Return the version of a stored session or session dict.'''
+    if isinstance(session_dict, LazySession):
+        return session_dict.version
+    else:
+        return session_dict.get(Session.VERSION, 0)
+
+
+def _to_dict(session_dict):
+    '''Return a plain ``dict`` copy of a stored session or session dict.'''
+    if isinstance(session_dict, LazySession):
+        return session_dict.to_session_dict()
+    else:
+        return dict(session_dict)
+
+
+class CookieSessionController(BaseSessionController):
+    DATA_PREFIX = b'j'
+    COMPRESSED_DATA_PREFIX = b'z'
+    ID_PREFIX = b'i'
+
+    def __init__(self, fallback=None, max_size=2800, compress_threshold=200):
+        '''Store sessions in the secure cookie itself.
+
+        Sessions are saved as compact JSON, compressed with zlib when
+        larger than `compress_threshold` bytes. Sessions that are larger
+        than `max_size` bytes or that do not read back unchanged from JSON
+        are saved by `fallback` and only their ID is put in the cookie.
+        Once a session is saved by `fallback`, it stays there.
+
+        :param fallback: A :class:`BaseSessionController` or ``None``.
+        :param max_size: The maximum number of bytes before signing. Web
+            browsers limit cookies to about 4 KB after signing and base64.
+        '''
+        self._fallback = fallback
+        self._max_size = max_size
+        self._compress_threshold = compress_threshold
+
+    @property
+    def fallback(self):
+        '''The server-side :class:`BaseSessionController` or ``None``.'''
+        return self._fallback
+
+    def get_session_dict(self, id_):
+        if self._fallback:
+            return self._fallback.get_session_dict(id_)
+
+    def save_session_dict(self, session_dict):
+        if not self._fallback:
+            raise ValueError('Session is too large for a cookie')
+
+        self._fallback.save_session_dict(session_dict)
+
+    def clean(self, max_items=None):
+        if self._fallback:
+            return self._fallback.clean(max_items)
+
+    def get_session_dicts(self, ids):
+        if self._fallback:
+            return self._fallback.get_session_dicts(ids)
+        else:
+            return {}
+
+    def save_session_dicts(self, session_dicts):
+        if not self._fallback:
+            raise ValueError('Session is too large for a cookie')
+
+        self._fallback.save_session_dicts(session_dicts)
+
+    def _get_session(self, request_handler):
+        value = self._get_session_id(request_handler)
+        stored_session_dict = None
+
+        if value and value.startswith(self.ID_PREFIX):
+            stored_session_dict = self.get_session_dict(
+                value[len(self.ID_PREFIX):])
+        elif value:
+            stored_session_dict = self._decode(value)
+
+        return self._load_session(stored_session_dict)
+
+    def _finish_session(self, request_handler, session):
+        if session.id is not None:
+            BaseSessionController._finish_session(self, request_handler,
+                session)
+            return
 
-    def clean(self):
         time_now = time.time()
+        need_touch = session.cookie_timestamp and \
+            time_now - session.cookie_timestamp > \
+            BaseSessionController.COOKIE_SET_INTERVAL
+
+        if not session.dirty and not need_touch:
+            return
+
+        session.cookie_timestamp = int(time_now)
+        session.last_modified = int(time_now)
+        value = self._encode(session)
+
+        if value is None:
+            session.cookie_timestamp = 0
+            BaseSessionController._finish_session(self, request_handler,
+                session)
+            return
+
+        self._set_cookie(request_handler, session, value)
+        session.mark_clean()
+
+    def _send_cookie(self, request_handler, session):
+        self._set_cookie(request_handler, session, self.ID_PREFIX + session.id)
+
+    def _set_cookie(self, request_handler, session, value):
+        expires_days = 30 if session.persistent else None
+
+        request_handler.set_secure_cookie(BaseSessionController.COOKIE_NAME,
+            value, expires_days=expires_days)
+
+    def _encode(self, session):
+        '''Return the cookie value or ``None`` if it does not fit.
+
+        Sessions that JSON would change, such as ones with tuples or
+        keys that are not strings, do not fit either.
+        '''
+        session_dict = dict((k, v) for k, v in session.items()
+            if k != Session.ID)
+
+        try:
+            data = json.dumps(session_dict, separators=(',', ':')).encode()
+        except (TypeError, ValueError):
+            return None
+
+        if json.loads(data.decode()) != session_dict:
+            return None
+
+        if len(data) > self._compress_threshold:
+            value = self.COMPRESSED_DATA_PREFIX + zlib.compress(data)
+        else:
+            value = self.DATA_PREFIX + data
+
+        if len(value) <= self._max_size:
+            return value
+
+    def _decode(self, value):
+        '''Return the session dict or ``None`` if it is not valid.'''
+        prefix = value[:1]
+        data = value[1:]
+
+        try:
+            if prefix == self.COMPRESSED_DATA_PREFIX:
+                data = zlib.decompress(data)
+            elif prefix != self.DATA_PREFIX:
+                return None
+
+            session_dict = json.loads(data.decode())
+        except (zlib.error, ValueError):
+            return None
+
+        if isinstance(session_dict, dict):
+            return session_dict
+
+
+class AsyncMemorySessionController(AsyncBaseSessionController):
+    '''Provides a in-memory asynchronous session controller for testing.'''
+    def __init__(self):
+        self._controller = MemorySessionController()
+
+    async def get_session_dict(self, id_):
+        return self._controller.get_session_dict(id_)
+
+    async def save_session_dict(self, session_dict):
+        self._controller.save_session_dict(session_dict)
+
+    async def clean(self, max_items=None):
+        return self._controller.clean(max_items)
+
+    async def get_session_dicts(self, ids):
+        return self._controller.get_session_dicts(ids)
+
+    async def save_session_dicts(self, session_dicts):
+        self._controller.save_session_dicts(session_dicts)
+
+
+class ThreadedSessionController(AsyncBaseSessionController):
+    def __init__(self, controller, executor=None):
+        '''Run a blocking session controller in threads.
+
+        :param controller: A :class:`BaseSessionController`.
+        :param executor: A :class:`concurrent.futures.Executor`. If not
+            given, the default executor of the event loop is used.
+        '''
+        self._controller = controller
+        self._executor = executor
+
+    @property
+    def controller(self):
+        '''The wrapped :class:`BaseSessionController`.'''
+        return self._controller
+
+    async def get_session_dict(self, id_):
+        return await self._run(self._controller.get_session_dict, id_)
+
+    async def save_session_dict(self, session_dict):
+        await self._run(self._controller.save_session_dict, session_dict)
+
+    async def clean(self, max_items=None):
+        return await self._run(self._controller.clean, max_items)
+
+    async def get_session_dicts(self, ids):
+        return await self._run(self._controller.get_session_dicts, list(ids))
+
+    async def save_session_dicts(self, session_dicts):
+        await self._run(self._controller.save_session_dicts,
+            list(session_dicts))
 
-        for k in list(self._table.keys()):
-            session = self._table[k]
+    def _run(self, function, *args):
+        loop = asyncio.get_event_loop()
 
-            if session.last_modified - time_now > \
-            BaseSessionController.EXPIRE_TIME:
-                del self._table[k]
+        return loop.run_in_executor(self._executor, function, *args)
@@ -1,8 +1,15 @@
-from pywheel.tornado.session import MemorySessionController
+from pywheel.web.tornado.session import (AsyncMemorySessionController,
+    CachingSessionController, CookieSessionController, LazySession,
+    MemorySessionController, Session, SessionCleaner,
+    StripedMemorySessionController, ThreadedSessionController)
 from tornado.httputil import url_concat
+import asyncio
 import http.client
+import os
+import time
 import tornado.testing
 import tornado.web
+import unittest
 
 
 class SessionHandler(tornado.web.RequestHandler):
@@ -94,3 +101,466 @@ class TestSessionController(tornado.testing.AsyncHTTPTestCase):
 
         self.assertIn('expires', cookie_value,
             'It should be a persistent cookie')
+
+
+class FakeRequestHandler(object):
+    def __init__(self, cookie=None):
+        self.cookie = cookie
+        self.cookie_count = 0
+
+    def get_secure_cookie(self, name):
+        return self.cookie
+
+    def set_secure_cookie(self, name, value, expires_days=None):
+        self.cookie = value
+        self.cookie_count += 1
+
+
+class CountingSessionController(MemorySessionController):
+    def __init__(self, lazy=False):
+        MemorySessionController.__init__(self, lazy)
+        self.save_count = 0
+
+    def save_session_dict(self, session_dict):
+        self.save_count += 1
+        MemorySessionController.save_session_dict(self, session_dict)
+
+
+class TestWriteAvoidance(unittest.TestCase):
+    def test_unchanged_not_saved(self):
+        '''It should only save sessions that changed'''
+
+        controller = CountingSessionController()
+        handler = FakeRequestHandler()
+
+        with controller(handler):
+            pass
+
+        self.assertEqual(0, controller.save_count)
+
+        with controller(handler) as session:
+            session['text'] = 'kittens'
+
+        self.assertEqual(1, controller.save_count)
+        self.assertEqual(1, handler.cookie_count)
+
+        with controller(handler) as session:
+            self.assertEqual('kittens', session['text'])
+            session['text'] = 'kittens'
+
+        self.assertEqual(1, controller.save_count)
+
+        with controller(handler) as session:
+            session['text'] = 'puppies'
+
+        self.assertEqual(2, controller.save_count)
+        self.assertEqual(1, handler.cookie_count)
+
+    def test_touch(self):
+        '''It should save unchanged sessions after the touch interval'''
+
+        controller = CountingSessionController()
+        handler = FakeRequestHandler()
+
+        with controller(handler) as session:
+            session['text'] = 'kittens'
+
+        controller.TOUCH_INTERVAL = -1
+
+        with controller(handler):
+            pass
+
+        self.assertEqual(2, controller.save_count)
+
+
+class TestMemorySessionController(unittest.TestCase):
+    def test_clean(self):
+        '''It should delete only expired sessions, oldest first'''
+
+        controller = MemorySessionController()
+        session_dicts = [Session() for dummy in range(5)]
+
+        for i, session_dict in enumerate(session_dicts):
+            session_dict.last_modified = i
+            controller.save_session_dict(session_dict)
+
+        session_dicts[0].last_modified = int(time.time())
+        controller.save_session_dict(session_dicts[0])
+
+        self.assertEqual(2, controller.clean(max_items=2))
+        self.assertFalse(controller.get_session_dict(session_dicts[1].id))
+        self.assertTrue(controller.get_session_dict(session_dicts[3].id))
+        self.assertEqual(2, controller.clean())
+        self.assertTrue(controller.get_session_dict(session_dicts[0].id))
+        self.assertEqual(0, controller.clean())
+
+    def test_cleaner(self):
+        '''It should clean in the background'''
+
+        controller = MemorySessionController()
+
+        for dummy in range(5):
+            controller.save_session_dict(Session())
+
+        cleaner = SessionCleaner(controller, interval=0.01, max_items=2)
+        time.sleep(0.1)
+        cleaner.stop()
+        cleaner.join(timeout=0.1)
+
+        self.assertFalse(cleaner.is_alive())
+        self.assertEqual(0, controller.clean())
+
+
+class TestStripedMemorySessionController(unittest.TestCase):
+    def test_simple(self):
+        '''It should save and load sessions'''
+
+        controller = StripedMemorySessionController(shards=4)
+        handler = FakeRequestHandler()
+
+        with controller(handler) as session:
+            session['text'] = 'kittens'
+
+        with controller(handler) as session:
+            self.assertEqual('kittens', session['text'])
+
+        self.assertEqual(1, len(controller))
+        self.assertTrue(controller.size)
+
+    def test_limits(self):
+        '''It should evict the least recently used sessions'''
+
+        controller = StripedMemorySessionController(shards=1, max_items=2)
+        session_dicts = [Session(text='kittens') for dummy in range(3)]
+
+        for session_dict in session_dicts:
+            session_dict.last_modified = int(time.time())
+
+        for session_dict in session_dicts[:2]:
+            controller.save_session_dict(session_dict)
+
+        controller.get_session_dict(session_dicts[0].id)
+        controller.save_session_dict(session_dicts[2])
+
+        self.assertTrue(controller.get_session_dict(session_dicts[0].id))
+        self.assertFalse(controller.get_session_dict(session_dicts[1].id))
+        self.assertEqual(1, controller.evictions)
+
+        size = controller.size
+        controller = StripedMemorySessionController(shards=1,
+            max_size=size // 2 + 1)
+
+        for session_dict in session_dicts[:2]:
+            controller.save_session_dict(session_dict)
+
+        self.assertEqual(1, len(controller))
+        self.assertLessEqual(controller.size, size // 2 + 1)
+
+        controller = StripedMemorySessionController(shards=4, max_items=6)
+
+        for dummy in range(200):
+            controller.save_session_dict(Session(text='kittens'))
+
+        self.assertEqual(6, len(controller))
+        self.assertRaises(ValueError, StripedMemorySessionController,
+            shards=16, max_items=4)
+
+    def test_clean(self):
+        '''It should delete expired sessions'''
+
+        controller = StripedMemorySessionController(shards=2)
+        session_dicts = [Session() for dummy in range(4)]
+        session_dicts[3].last_modified = int(time.time())
+
+        for session_dict in session_dicts:
+            controller.save_session_dict(session_dict)
+
+        self.assertEqual(3, controller.clean())
+        self.assertEqual(1, len(controller))
+
+
+class TestLazySession(unittest.TestCase):
+    def test_lazy(self):
+        '''It should only decode sessions that are used'''
+
+        controller = CountingSessionController(lazy=True)
+        handler = FakeRequestHandler()
+
+        with controller(handler) as session:
+            self.assertIsInstance(session, LazySession)
+            session['text'] = 'kittens'
+            session.persistent = True
+
+        with controller(handler) as session:
+            pass
+
+        self.assertFalse(session.loaded)
+        self.assertEqual(1, controller.save_count)
+
+        with controller(handler) as session:
+            self.assertTrue(session.persistent)
+            self.assertEqual('kittens', session['text'])
+            session['text'] = 'puppies'
+
+        self.assertEqual(2, controller.save_count)
+
+        with controller(handler) as session:
+            session.persistent = False
+
+        self.assertEqual(3, controller.save_count)
+        self.assertEqual({'text': 'puppies'}, dict(
+            controller.get_session_dict(session.id)))
+
+    def test_from_dict(self):
+        '''It should convert to and from session dicts'''
+
+        session = Session(text='kittens')
+        session.id = b'1'
+        session.last_modified = 123
+        session.version = 2
+        lazy_session = LazySession.from_dict(session)
+
+        self.assertEqual(b'1', lazy_session.id)
+        self.assertEqual(123, lazy_session.last_modified)
+        self.assertEqual(2, lazy_session.version)
+        self.assertEqual({'text': 'kittens'}, dict(lazy_session))
+        self.assertEqual(dict(session), LazySession.from_bytes(b'1',
+            lazy_session.to_bytes()).to_session_dict())
+
+
+class TestBulk(unittest.TestCase):
+    def check_controller(self, controller):
+        session_dicts = [Session(number=i) for i in range(10)]
+
+        for session_dict in session_dicts:
+            session_dict.last_modified = int(time.time())
+
+        controller.save_session_dicts(session_dicts)
+
+        ids = [session_dict.id for session_dict in session_dicts[::3]]
+        test_dicts = controller.get_session_dicts(ids + [b'missing'])
+
+        self.assertEqual(set(ids), set(test_dicts))
+        self.assertEqual([0, 3, 6, 9],
+            [test_dicts[id_]['number'] for id_ in ids])
+
+        for session_dict in test_dicts.values():
+            session_dict['number'] += 100
+
+        controller.save_session_dicts(test_dicts.values())
+        test_dicts = controller.get_session_dicts(ids)
+
+        self.assertEqual([100, 103, 106, 109],
+            [test_dicts[id_]['number'] for id_ in ids])
+
+    def test_memory(self):
+        '''It should save and get many sessions'''
+
+        self.check_controller(MemorySessionController())
+
+    def test_striped(self):
+        '''It should save and get many sessions'''
+
+        self.check_controller(StripedMemorySessionController(shards=3))
+
+    def test_lazy(self):
+        '''It should save and get many lazy sessions'''
+
+        self.check_controller(MemorySessionController(lazy=True))
+        self.check_controller(StripedMemorySessionController(lazy=True))
+
+    def test_fallback(self):
+        '''It should save and get many sessions one at a time'''
+
+        self.check_controller(
+            CachingSessionController(MemorySessionController()))
+
+
+class TestAsyncSessionController(unittest.TestCase):
+    def check_controller(self, controller):
+        handler = FakeRequestHandler()
+
+        async def run():
+            async with controller(handler) as session:
+                session['text'] = 'kittens'
+
+            async with controller(handler) as session:
+                self.assertEqual('kittens', session['text'])
+
+            await controller.clean()
+
+        asyncio.run(run())
+
+        self.assertEqual(1, handler.cookie_count)
+
+    def test_memory(self):
+        '''It should save and load the session'''
+
+        self.check_controller(AsyncMemorySessionController())
+
+    def test_threaded(self):
+        '''It should run the wrapped controller in threads'''
+
+        self.check_controller(
+            ThreadedSessionController(MemorySessionController()))
+
+
+class TestCachingSessionController(unittest.TestCase):
+    def test_cache(self):
+        '''It should read sessions from the cache until they expire'''
+
+        backend = MemorySessionController()
+        controller = CachingSessionController(backend, ttl=0.1)
+        other_controller = CachingSessionController(backend, ttl=60)
+        handler = FakeRequestHandler()
+
+        with controller(handler) as session:
+            session['text'] = 'kittens'
+
+        with controller(handler) as session:
+            self.assertEqual('kittens', session['text'])
+            session['text'] = 'puppies'
+
+        self.assertEqual(1, controller.hits)
+        self.assertEqual(0, controller.misses)
+
+        with other_controller(handler) as session:
+            self.assertEqual('puppies', session['text'])
+            session['text'] = 'birds'
+
+        with controller(handler) as session:
+            self.assertEqual('puppies', session['text'])
+
+        time.sleep(0.1)
+
+        with controller(handler) as session:
+            self.assertEqual('birds', session['text'])
+
+        self.assertEqual(1, controller.stale)
+        self.assertEqual(2, controller.hits)
+        self.assertEqual(1, controller.misses)
+
+    def test_lost_update(self):
+        '''It should use the stored session once the cached one expires'''
+
+        backend = MemorySessionController()
+        controller = CachingSessionController(backend, ttl=0.1)
+        other_controller = CachingSessionController(backend, ttl=60)
+        handler = FakeRequestHandler()
+
+        with controller(handler) as session:
+            session['text'] = 'A1'
+
+        other_handler = FakeRequestHandler(handler.cookie)
+
+        with other_controller(other_handler) as other_session:
+            with controller(handler) as session:
+                session['text'] = 'A2'
+
+            other_session['text'] = 'B'
+
+        time.sleep(0.1)
+
+        for dummy in range(2):
+            with controller(handler) as session:
+                self.assertEqual('B', session['text'])
+                self.assertFalse(session.dirty)
+
+        self.assertEqual(1, controller.stale)
+        self.assertEqual(2, controller.hits)
+        self.assertEqual(1, controller.misses)
+
+    def test_lazy(self):
+        '''It should keep the properties of lazy sessions'''
+
+        for backend in (MemorySessionController(lazy=True),
+        StripedMemorySessionController(lazy=True)):
+            controller = CachingSessionController(backend, ttl=60)
+            handler = FakeRequestHandler()
+
+            with controller(handler) as session:
+                session['text'] = 'kittens'
+                session.persistent = True
+
+            cookie = handler.cookie
+            controller.cache.clear()
+
+            for dummy in range(2):
+                with controller(handler) as session:
+                    self.assertEqual(cookie, session.id)
+                    self.assertTrue(session.persistent)
+                    session['text'] = 'puppies'
+
+            self.assertEqual(cookie, handler.cookie)
+            self.assertEqual('puppies',
+                backend.get_session_dict(cookie)['text'])
+
+
+class TestCookieSessionController(unittest.TestCase):
+    def test_cookie(self):
+        '''It should store small sessions in the cookie'''
+
+        fallback = CountingSessionController()
+        controller = CookieSessionController(fallback, compress_threshold=10)
+        handler = FakeRequestHandler()
+
+        with controller(handler) as session:
+            session['text'] = 'kittens'
+
+        with controller(handler) as session:
+            self.assertEqual('kittens', session['text'])
+
+        self.assertEqual(1, handler.cookie_count)
+        self.assertTrue(handler.cookie.startswith(b'z'))
+        self.assertEqual(0, fallback.save_count)
+
+    def test_fallback(self):
+        '''It should store large sessions server-side'''
+
+        fallback = CountingSessionController()
+        controller = CookieSessionController(fallback, max_size=100)
+        handler = FakeRequestHandler()
+
+        text = os.urandom(200).hex()
+
+        with controller(handler) as session:
+            session['text'] = text
+
+        with controller(handler) as session:
+            self.assertEqual(text, session['text'])
+            session['text'] = 'kittens'
+
+        with controller(handler) as session:
+            self.assertEqual('kittens', session['text'])
+
+        self.assertEqual(2, fallback.save_count)
+        self.assertTrue(handler.cookie.startswith(b'i'))
+
+    def test_json_types(self):
+        '''It should store sessions that JSON would change server-side'''
+
+        fallback = CountingSessionController()
+        controller = CookieSessionController(fallback)
+        handler = FakeRequestHandler()
+
+        with controller(handler) as session:
+            session[1] = ('a', 'b')
+
+        with controller(handler) as session:
+            self.assertEqual(('a', 'b'), session[1])
+
+        self.assertEqual(1, fallback.save_count)
+
+    def test_invalid(self):
+        '''It should ignore cookies that are not sessions'''
+
+        controller = CookieSessionController()
+
+        with controller(FakeRequestHandler(b'z123')) as session:
+            self.assertNotIn('text', session)
+
+        def f():
+            with controller(FakeRequestHandler()) as session:
+                session['text'] = os.urandom(3000).hex()
+
+        self.assertRaises(ValueError, f)